@@ -0,0 +1,3 @@
+"""
+Benchmarks for the ingestion pipeline; see benchmarks/run.py.
+"""
@@ -0,0 +1,136 @@
+"""
+Synthetic, reproducible fixtures for the benchmarks.
+
+Everything is generated from a fixed seed into a directory laid out by host,
+so the stand-in HTTP server can serve it as if it were the real sites:
+
+    <root>/bench.local/index.html             a listing of CSV files
+    <root>/bench.local/data/part-N.csv
+    <root>/www.data.gov/raw/994               a data.gov dataset page
+    <root>/explore.data.gov/download/bench-0001/CSV
+    <root>/archives/nested.zip                a zip holding a tarball of CSVs
+    <root>/csv/rows-N.csv
+"""
+
+import os
+import csv
+import random
+import tarfile
+import zipfile
+
+from datetime import date, timedelta
+
+SEED = 1010
+STATES = ('AL', 'AK', 'AZ', 'CA', 'CO', 'FL', 'GA', 'NY', 'TN', 'TX', 'VA')
+HEADER = ['Id', 'Name', 'Amount', 'Date', 'Active', 'State', 'Notes']
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def _makedirs(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+def write_csv(filename, rows, seed=SEED):
+    """
+    Write a CSV file of `rows` rows, with integer, string, float, date,
+    boolean, low cardinality and free text columns.
+    """
+    if os.path.exists(filename):
+        return filename
+    _makedirs(os.path.dirname(filename))
+    rand = random.Random(seed)
+    start = date(2000, 1, 1)
+    partial = filename + '.part'
+    with open(partial, 'wb') as out:
+        writer = csv.writer(out)
+        writer.writerow(HEADER)
+        batch = []
+        for i in xrange(rows):
+            batch.append([
+                i,
+                'Name %d' % rand.randint(0, rows),
+                '%.2f' % (rand.random() * 10000),
+                (start + timedelta(days=rand.randint(0, 5000))).isoformat(),
+                rand.choice(('true', 'false')),
+                rand.choice(STATES),
+                ' '.join(rand.choice(WORDS)
+                         for j in range(rand.randint(0, 40))),
+            ])
+            if len(batch) == 10000:
+                writer.writerows(batch)
+                batch = []
+        writer.writerows(batch)
+    os.rename(partial, filename)
+    return filename
+
+def write_listing(root, files=20, rows=10000):
+    """ Write a listing page linking to `files` CSV files of `rows` rows """
+    host = os.path.join(root, 'bench.local')
+    _makedirs(os.path.join(host, 'data'))
+    links = []
+    for i in range(files):
+        name = 'part-%d.csv' % i
+        write_csv(os.path.join(host, 'data', name), rows, SEED + i)
+        links.append('<li><a href="/data/%s">Part %d</a></li>' % (name, i))
+    with open(os.path.join(host, 'index.html'), 'w') as page:
+        page.write('<html><head><title>Bench</title></head><body><ul>%s'
+                   '</ul><a href="/about.html">About</a></body></html>' %
+                   ''.join(links))
+    with open(os.path.join(host, 'about.html'), 'w') as page:
+        page.write('<html><body><a href="/">Home</a></body></html>')
+    return u'http://bench.local/index.html'
+
+def write_data_gov(root, rows=10000):
+    """ Write a data.gov dataset page, and the CSV it links to """
+    fields = [('Agency', 'Department of Benchmarks'),
+              ('Sub-Agency', 'Bureau of Throughput'),
+              ('Category', 'Performance'),
+              ('Date Released', '01/02/2010'),
+              ('Frequency', 'Nightly'),
+              ('Description', 'Synthetic data for the PolyScraper benchmarks'),
+              ('Unique ID', '994')]
+    rows_html = ''.join('<tr><td>%s</td><td>%s</td></tr>' % field
+                        for field in fields)
+    raw = os.path.join(root, 'www.data.gov', 'raw')
+    _makedirs(raw)
+    with open(os.path.join(raw, '994'), 'w') as page:
+        page.write('<html><body><h2 id="datasetName">Benchmark Dataset</h2>'
+                   '<table>%s</table>'
+                   '<a href="/download/bench-0001/CSV">CSV</a>'
+                   '</body></html>' % rows_html)
+    write_csv(os.path.join(root, 'explore.data.gov', 'download', 'bench-0001',
+                           'CSV'), rows)
+    return u'http://www.data.gov/raw/994'
+
+def write_nested_archive(root, files=4, rows=10000):
+    """ Write a zip file holding a gzipped tarball of CSV files """
+    dirname = os.path.join(root, 'archives')
+    filename = os.path.join(dirname, 'nested.zip')
+    if os.path.exists(filename):
+        return filename
+    _makedirs(dirname)
+    members = [write_csv(os.path.join(dirname, 'members', 'member-%d.csv' % i),
+                         rows, SEED + i) for i in range(files)]
+    tarball = os.path.join(dirname, 'members.tar.gz')
+    with tarfile.open(tarball, 'w:gz') as tar:
+        for member in members:
+            tar.add(member, os.path.basename(member))
+    with zipfile.ZipFile(filename + '.part', 'w', zipfile.ZIP_DEFLATED) as z:
+        z.write(tarball, 'members.tar.gz')
+    os.rename(filename + '.part', filename)
+    return filename
+
+def generate(root, sizes):
+    """
+    Generate every fixture under `root`, reusing any that already exist,
+    and return where to find them.
+    """
+    return {
+        'listing': write_listing(root),
+        'data_gov': write_data_gov(root),
+        'archive': write_nested_archive(root),
+        'csv': dict((rows, write_csv(os.path.join(root, 'csv',
+                                                  'rows-%d.csv' % rows), rows))
+                    for rows in sizes),
+    }
@@ -0,0 +1,235 @@
+"""
+Benchmarks for the PolyScraper ingestion pipeline.
+
+    $ python -m benchmarks.run
+    $ python -m benchmarks.run --sizes 10000,1000000,10000000 \\
+          --postgres postgresql://civx@localhost/civx_bench \\
+          --output results-0.2.json --baseline results-0.1.json
+
+Fixtures are generated once into --fixtures, and served by a local stand-in
+for the web, so nothing leaves the machine.  Each benchmark runs in a fresh
+process, against a fresh SQLite database and then the --postgres one if
+given, which is emptied before each benchmark.  It reports its wall time, the time, calls, bytes and rows of each
+scrape stage, and its peak memory.  The results are written as JSON;
+passing the results of an earlier run as --baseline prints how much each
+benchmark sped up or slowed down.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import optparse
+import platform
+import resource
+import tempfile
+import traceback
+import subprocess
+import multiprocessing
+
+from Queue import Empty
+
+from benchmarks import fixtures
+from benchmarks.server import FixtureServer
+
+log = logging.getLogger('benchmarks')
+
+
+def make_scraper(db_url, workdir):
+    """
+    Return a PolyScraper writing to `workdir`, with a fresh database: every
+    table already in it, the civx_* tables of earlier runs included, is
+    dropped first.
+    """
+    from sqlalchemy import MetaData, create_engine
+    from knowledge.model import init_model, metadata
+    from polyscraper.poly import PolyScraper
+
+    engine = create_engine(db_url)
+    existing = MetaData()
+    existing.reflect(bind=engine)
+    existing.drop_all(bind=engine)
+    init_model(engine)
+    metadata.create_all(engine)
+    scraper = PolyScraper()
+    scraper.config.update({
+        'git_dir': os.path.join(workdir, 'git'),
+        'crawl_delay': 0,
+    })
+    return scraper
+
+def _file_entity(filename):
+    from knowledge.model import DBSession, Entity
+    parent = Entity(name=u'bench')
+    parent[u'repo'] = u'bench'
+    entity = Entity(name=unicode(filename))
+    entity[u'filename'] = unicode(filename)
+    entity.parent = parent
+    DBSession.add(parent)
+    DBSession.add(entity)
+    DBSession.flush()
+    return entity
+
+def bench_consume(scraper, workdir, url):
+    """ Scrape a url from start to finish """
+    scraper.consume(url)
+
+def bench_archive(scraper, workdir, filename):
+    """ Run the magic handlers on a nested archive, and everything in it """
+    scraper.init_git_repo(u'bench')
+    path = os.path.join(scraper.get_repo_dir(), os.path.basename(filename))
+    shutil.copy(filename, path)
+    entity = _file_entity(path)
+    entity[u'magic'] = scraper.call_magic_handler(path, entity)
+
+def bench_csv(scraper, workdir, filename):
+    """ Load a CSV file into a new table """
+    entity = _file_entity(filename)
+    scraper.polymorphic_csv_populator(entity)
+    if u'table_name' not in entity.facts:
+        raise Exception("%s wasn't loaded" % filename)
+
+def _throughput(stages):
+    """ Add the rate of the bytes and rows of each stage """
+    for counts in stages.values():
+        seconds = counts.get(u'seconds') or 0
+        for name in (u'bytes', u'rows'):
+            if name in counts and seconds:
+                counts[name + u'_per_second'] = round(counts[name] / seconds)
+    return stages
+
+def _child(benchmark, arg, db_url, proxy, results):
+    """ Run one benchmark in this (fresh) process, and report back """
+    os.environ['http_proxy'] = proxy
+    os.environ.pop('no_proxy', None)
+    workdir = tempfile.mkdtemp(prefix='polybench-')
+    try:
+        if db_url is None:
+            db_url = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+        scraper = make_scraper(db_url, workdir)
+        baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        scraper.metrics.reset()
+        start = time.time()
+        benchmark(scraper, workdir, arg)
+        elapsed = time.time() - start
+        results.put({
+            'seconds': round(elapsed, 3),
+            'stages': _throughput(scraper.metrics.summary()),
+            'baseline_rss_kb': baseline_rss,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+    except Exception:
+        results.put({'error': traceback.format_exc()})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_benchmark(name, benchmark, arg, db_url, proxy):
+    """ Run a benchmark in a child process, and return its results """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_child, args=(
+        benchmark, arg, db_url, proxy, results))
+    process.start()
+    process.join()
+    try:
+        result = results.get(timeout=1)
+    except Empty:
+        result = {'error': 'exited with %s' % process.exitcode}
+    result['name'] = name
+    result['database'] = db_url and db_url.split(':')[0] or 'sqlite'
+    if 'error' in result:
+        log.error("%s failed:\n%s" % (name, result['error']))
+    else:
+        log.info("%s on %s: %.2fs, %d KB peak" % (
+            name, result['database'], result['seconds'],
+            result['peak_rss_kb']))
+    return result
+
+def environment():
+    """ Describe what the benchmarks ran on """
+    env = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+    try:
+        import sqlalchemy
+        env['sqlalchemy'] = sqlalchemy.__version__
+    except ImportError:
+        pass
+    try:
+        env['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return env
+
+def compare(results, baseline):
+    """ Print how each benchmark changed since the baseline """
+    before = dict(((r['name'], r['database']), r) for r in baseline['results']
+                  if 'seconds' in r)
+    for result in results:
+        old = before.get((result['name'], result['database']))
+        if not old or 'seconds' not in result:
+            continue
+        print '%-24s %-10s %8.2fs -> %8.2fs (%+.0f%%)  %d KB -> %d KB' % (
+            result['name'], result['database'], old['seconds'],
+            result['seconds'],
+            (result['seconds'] / (old['seconds'] or 1e-9) - 1) * 100,
+            old['peak_rss_kb'], result['peak_rss_kb'])
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--fixtures', default=os.path.join(
+                          tempfile.gettempdir(), 'polybench-fixtures'),
+                      help='where to generate, or find, the fixtures')
+    parser.add_option('--sizes', default='10000,1000000',
+                      help='rows in each CSV benchmark, comma separated')
+    parser.add_option('--postgres', metavar='URL',
+                      help='also run against this PostgreSQL database')
+    parser.add_option('--only', metavar='NAME',
+                      help='only run benchmarks whose name starts with NAME')
+    parser.add_option('--output', default='benchmark-results.json')
+    parser.add_option('--baseline', metavar='FILE',
+                      help='results of an earlier run to compare against')
+    options, args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+    log.setLevel(logging.INFO)
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    log.info("Generating fixtures in %s" % options.fixtures)
+    paths = fixtures.generate(options.fixtures, sizes)
+
+    benchmarks = [
+        ('consume-listing', bench_consume, paths['listing']),
+        ('consume-data.gov', bench_consume, paths['data_gov']),
+        ('magic-nested-archive', bench_archive, paths['archive']),
+    ] + [('csv-%d' % rows, bench_csv, paths['csv'][rows]) for rows in sizes]
+    if options.only:
+        benchmarks = [b for b in benchmarks if b[0].startswith(options.only)]
+
+    server = FixtureServer(options.fixtures).start()
+    results = []
+    try:
+        for db_url in [None] + (options.postgres and [options.postgres] or []):
+            for name, benchmark, arg in benchmarks:
+                results.append(run_benchmark(name, benchmark, arg, db_url,
+                                             server.url))
+    finally:
+        server.stop()
+
+    with open(options.output, 'w') as out:
+        json.dump({'environment': environment(), 'results': results}, out,
+                  indent=2, sort_keys=True)
+    log.info("Wrote %s" % options.output)
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            compare(results, json.load(baseline))
+    return any('error' in result for result in results) and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+A local stand-in for the web, serving the fixtures by host.
+
+The server acts as an HTTP proxy: pointing `http_proxy` at it sends every
+request, for any host, to <root>/<host without www.>/<path> instead, so the
+scraper's hardcoded hosts (like explore.data.gov) work offline too.
+"""
+
+import os
+import shutil
+import threading
+import SocketServer
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from email.utils import formatdate
+from urlparse import urlparse
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def translate_path(self):
+        parsed = urlparse(self.path)
+        host = parsed.netloc or self.headers.get('Host', '')
+        host = host.split(':')[0]
+        path = os.path.normpath('/' + parsed.path).lstrip('/')
+        root = self.server.root
+        for name in (host, host.replace('www.', '', 1)):
+            filename = os.path.join(root, name, path)
+            if os.path.isdir(filename):
+                filename = os.path.join(filename, 'index.html')
+            if os.path.isfile(filename):
+                return filename
+
+    def do_GET(self):
+        filename = self.translate_path()
+        if filename is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        st = os.stat(filename)
+        start = 0
+        if self.headers.get('Range', '').startswith('bytes='):
+            start = int(self.headers['Range'][6:].split('-')[0])
+        if start >= st.st_size and start:
+            self.send_response(416)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(start and 206 or 200)
+        if filename.endswith('.html') or '/raw/' in filename:
+            self.send_header('Content-Type', 'text/html')
+        else:
+            self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(st.st_size - start))
+        self.send_header('Last-Modified', formatdate(st.st_mtime, usegmt=True))
+        if start:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, st.st_size - 1, st.st_size))
+        self.end_headers()
+        with open(filename, 'rb') as data:
+            data.seek(start)
+            shutil.copyfileobj(data, self.wfile, 1024 * 1024)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(SocketServer.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FixtureHandler)
+        self.root = root
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
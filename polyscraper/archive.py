@@ -0,0 +1,170 @@
+"""
+In-process archive extraction.
+
+Handles zip files (including self-extracting .exe zips), tarballs, and
+single files compressed with gzip, bzip2 or xz, without shelling out.
+"""
+
+import os
+import bz2
+import gzip
+import shutil
+import tarfile
+import zipfile
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+from polyscraper.local import replacing
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+CHUNK_SIZE = 1024 * 1024
+
+# Leading bytes of the single-file compression formats
+COMPRESSORS = (
+    ('\x1f\x8b', 'gz', gzip.GzipFile),
+    ('BZh', 'bz2', bz2.BZ2File),
+    ('\xfd7zXZ\x00', 'xz', lzma and lzma.LZMAFile),
+)
+
+
+class ArchiveError(Exception):
+    """ A file could not be read as an archive """
+
+
+def get_format(filename):
+    """ Return the archive format of a file: zip, tar, gz, bz2 or xz """
+    if zipfile.is_zipfile(filename):
+        return 'zip'
+    try:
+        if tarfile.is_tarfile(filename):
+            return 'tar'
+    except (IOError, EOFError):
+        pass
+    with open(filename, 'rb') as f:
+        head = f.read(6)
+    for magic, format, opener in COMPRESSORS:
+        if head.startswith(magic) and opener:
+            return format
+    raise ArchiveError("Unknown archive format: %s" % filename)
+
+def _opener(format):
+    for magic, name, opener in COMPRESSORS:
+        if name == format:
+            return opener
+
+def _target(dest, name):
+    """ Return where a member should be extracted, refusing to leave `dest` """
+    dest = os.path.abspath(dest)
+    path = os.path.abspath(os.path.join(dest, name))
+    if not path.startswith(dest + os.sep):
+        raise ArchiveError("Refusing to extract %s outside of %s" % (
+            name, dest))
+    return path
+
+def _write(fileobj, path):
+    """ Stream a file object to disk, replacing whatever was at `path` """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Another worker beat us to it
+            if not os.path.isdir(dirname):
+                raise
+    with replacing(path) as out:
+        shutil.copyfileobj(fileobj, out, CHUNK_SIZE)
+
+def _decompressed_name(filename, format):
+    """ Return the name a single compressed file decompresses to """
+    name = os.path.basename(filename)
+    if name.endswith('.' + format):
+        return name[:-len(format) - 1]
+    return name + '.out'
+
+def list_members(filename):
+    """ Return the names of the files within an archive """
+    format = get_format(filename)
+    if format == 'zip':
+        with zipfile.ZipFile(filename) as archive:
+            return [info.filename for info in archive.infolist()
+                    if not info.filename.endswith('/')]
+    elif format == 'tar':
+        with tarfile.open(filename) as archive:
+            return [info.name for info in archive if info.isfile()]
+    return [_decompressed_name(filename, format)]
+
+def iter_members(filename):
+    """
+    Yield (name, fileobj) pairs for each file within an archive, reading
+    the data straight out of the archive.  Each file object is only valid
+    until the next one is produced.
+    """
+    format = get_format(filename)
+    if format == 'zip':
+        with zipfile.ZipFile(filename) as archive:
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    member = archive.open(info)
+                    yield info.filename, member
+                    member.close()
+    elif format == 'tar':
+        # Stream mode, so compressed tarballs are only read once
+        with tarfile.open(filename, 'r|*') as archive:
+            for info in archive:
+                if info.isfile():
+                    yield info.name, archive.extractfile(info)
+    else:
+        member = _opener(format)(filename)
+        try:
+            yield _decompressed_name(filename, format), member
+        finally:
+            member.close()
+
+def extract(filename, dest, workers=4):
+    """
+    Extract an archive into `dest`, returning the paths of the extracted
+    files.  Zip members are decompressed in parallel by `workers` threads,
+    each with its own handle on the archive.
+    """
+    format = get_format(filename)
+    if format != 'zip' or workers <= 1:
+        extracted = []
+        for name, member in iter_members(filename):
+            path = _target(dest, name)
+            _write(member, path)
+            extracted.append(path)
+        return extracted
+
+    names = list_members(filename)
+    paths = [_target(dest, name) for name in names]
+
+    handles = threading.local()
+    opened = []
+
+    def unzip((name, path)):
+        archive = getattr(handles, 'archive', None)
+        if archive is None:
+            archive = handles.archive = zipfile.ZipFile(filename)
+            opened.append(archive)
+        member = archive.open(name)
+        try:
+            _write(member, path)
+        finally:
+            member.close()
+
+    pool = ThreadPool(min(workers, len(names)) or 1)
+    try:
+        pool.map(unzip, zip(names, paths))
+    finally:
+        pool.terminate()
+        for archive in opened:
+            archive.close()
+    return paths
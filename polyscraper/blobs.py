@@ -0,0 +1,47 @@
+"""
+A content-addressed store of downloaded files.
+
+Each distinct file is kept once, under its SHA-1, and linked into every
+place in the repos that it was downloaded to.
+"""
+
+import os
+import errno
+import shutil
+
+from polyscraper.local import link_or_copy
+
+
+class BlobStore(object):
+    """ Keeps one copy of each distinct file, named by its SHA-1 """
+
+    def __init__(self, path):
+        self.path = path
+
+    def path_of(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path_of(digest))
+
+    def store(self, filename, digest):
+        """
+        Move a file into the store, or drop it if the store already has its
+        contents, and link the stored copy back in at `filename`.  Returns
+        whether the store already had it.
+        """
+        blob = self.path_of(digest)
+        known = os.path.exists(blob)
+        if known:
+            os.unlink(filename)
+        else:
+            if not os.path.isdir(os.path.dirname(blob)):
+                os.makedirs(os.path.dirname(blob))
+            try:
+                os.rename(filename, blob)
+            except OSError, e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(filename, blob)
+        link_or_copy(blob, filename)
+        return known
@@ -0,0 +1,152 @@
+"""
+Caches that save the scraper round trips to the database and the web.
+"""
+
+import time
+import weakref
+import threading
+
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import Session, object_session
+from knowledge.model import Entity, DBSession
+
+# Every live EntityCache, so they can all hear about new entities
+_caches = weakref.WeakSet()
+
+# Keep IN clauses under SQLite's bound parameter limit
+WARM_CHUNK_SIZE = 500
+
+@event.listens_for(Session, 'after_attach')
+def _entity_attached(session, instance):
+    if isinstance(instance, Entity):
+        for cache in list(_caches):
+            cache.added(instance)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _rolled_back(session, previous_transaction):
+    # Anything added in the rolled back transaction is gone
+    for cache in list(_caches):
+        cache.clear()
+
+
+class EntityCache(object):
+    """
+    An identity cache in front of Entity.by_name.
+
+    Lookups that find nothing are cached too, and are replaced as soon as
+    an entity with that name is added to a session.  Entities kept from a
+    session that has since been closed are merged into the current one.
+    """
+
+    def __init__(self):
+        self.entities = {}
+        _caches.add(self)
+
+    def get(self, name):
+        """ Return the entity called `name`, or None """
+        try:
+            entity = self.entities[name]
+        except KeyError:
+            entity = self.entities[name] = Entity.by_name(name)
+            return entity
+        if entity is not None and object_session(entity) is not DBSession():
+            try:
+                entity = DBSession.merge(entity, load=False)
+            except InvalidRequestError:
+                # It had unsaved changes, so look it up again
+                entity = Entity.by_name(name)
+            self.entities[name] = entity
+        return entity
+
+    def warm(self, names):
+        """ Look up a bunch of entities with as few queries as possible """
+        names = [name for name in set(names) if name not in self.entities]
+        for i in range(0, len(names), WARM_CHUNK_SIZE):
+            chunk = names[i:i + WARM_CHUNK_SIZE]
+            query = DBSession.query(Entity).filter(Entity.name.in_(chunk))
+            for entity in query:
+                self.entities.setdefault(entity.name, entity)
+            for name in chunk:
+                self.entities.setdefault(name, None)
+
+    def added(self, entity):
+        """ Remember an entity that was just added to the session """
+        if entity.name is not None and self.entities.get(entity.name) is None:
+            self.entities[entity.name] = entity
+
+    def clear(self):
+        self.entities.clear()
+
+
+class Page(object):
+    """ A cached page: its raw bytes, validators and parsed trees """
+
+    def __init__(self, url, body, validators):
+        self.url = url
+        self.body = body
+        self.validators = validators
+        self.checked = time.time()
+        self.trees = {}
+
+
+class PageCache(object):
+    """
+    A least recently used cache of pages, keyed by URL and bounded by
+    `max_bytes`.  Parsed trees are kept with their page, and count as
+    `TREE_OVERHEAD` times the size of its body.
+    """
+
+    TREE_OVERHEAD = 4
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _cost(self, page):
+        return len(page.body) * (1 + self.TREE_OVERHEAD * len(page.trees))
+
+    def get(self, url):
+        """ Return the cached Page for a URL, or None """
+        with self.lock:
+            page = self.pages.pop(url, None)
+            if page is not None:
+                self.pages[url] = page
+            return page
+
+    def put(self, url, body, validators):
+        """ Cache the body of a page, replacing any previous version """
+        page = Page(url, body, validators)
+        with self.lock:
+            old = self.pages.pop(url, None)
+            if old is not None:
+                self.size -= self._cost(old)
+            self.pages[url] = page
+            self.size += self._cost(page)
+            self._evict()
+        return page
+
+    def add_tree(self, page, key, tree):
+        """ Keep a parsed tree of a cached page """
+        with self.lock:
+            if page.trees.get(key) is not None:
+                return
+            cost = self._cost(page)
+            page.trees[key] = tree
+            if self.pages.get(page.url) is page:
+                self.size += self._cost(page) - cost
+                self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.pages) > 1:
+            url, page = self.pages.popitem(last=False)
+            self.size -= self._cost(page)
+
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.size = 0
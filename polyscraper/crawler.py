@@ -0,0 +1,181 @@
+"""
+A polite, breadth-first link crawler for hosts without a URL handler.
+"""
+
+import math
+import time
+import struct
+import hashlib
+import logging
+import threading
+
+from multiprocessing.pool import ThreadPool
+from robotparser import RobotFileParser
+from urlparse import urljoin, urldefrag, urlparse
+
+from bs4 import SoupStrainer
+
+from polyscraper.scraper import NotHTML
+
+log = logging.getLogger('PolyScraper')
+
+
+class BloomFilter(object):
+    """
+    A compact set of strings.  It may claim to contain a string it doesn't
+    (about `error_rate` of the time once it holds `capacity` strings), but
+    never the other way around.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.size = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, int(round(self.size * math.log(2) / capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """ Add an item, returning whether it was new """
+        new = False
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                new = True
+        return new
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+
+class Crawler(object):
+    """
+    Crawls a site breadth first, up to `max_depth` links away from where it
+    started, and yields the links to files with one of the `extensions`.
+
+    Only pages on the starting host are followed.  Pages are fetched by a
+    pool of `workers` threads, with at most `host_pages` at a time and one
+    every `delay` seconds from any host, and only if robots.txt allows it.
+    """
+
+    user_agent = 'CIVX PolyScraper'
+    robots_timeout = 10
+
+    def __init__(self, scraper, extensions, max_depth=2, workers=4,
+                 host_pages=2, delay=1.0, max_urls=1000000,
+                 max_frontier=100000):
+        self.scraper = scraper
+        self.extensions = set(ext.strip().lower() for ext in extensions)
+        self.max_depth = max_depth
+        self.workers = workers
+        self.host_pages = host_pages
+        self.delay = delay
+        self.max_frontier = max_frontier
+        self.visited = BloomFilter(max_urls)
+        self.lock = threading.Lock()
+        self.robots = {}
+        self.next_visit = {}
+        self.host_locks = {}
+        self.strainer = SoupStrainer('a', href=True)
+
+    def is_file(self, link):
+        """ Return whether a link points to a data file """
+        path = urlparse(link)[2].lower()
+        if path.rsplit('.', 1)[-1] in self.extensions:
+            return True
+        return any('/%s/' % ext in path for ext in self.extensions)
+
+    def allowed(self, url):
+        """ Return whether robots.txt lets us fetch a url """
+        parsed = urlparse(url)
+        host = '%s://%s' % (parsed[0], parsed[1])
+        with self.lock:
+            robots = self.robots.get(host)
+        if robots is None:
+            robots = RobotFileParser(host + '/robots.txt')
+            try:
+                # Like RobotFileParser.read, but with a timeout, and over
+                # the scraper's keep-alive session
+                response = self.scraper.get_session().get(
+                        robots.url, timeout=self.robots_timeout)
+                if response.status_code in (401, 403):
+                    robots.disallow_all = True
+                elif response.status_code >= 400:
+                    robots.allow_all = True
+                else:
+                    robots.parse(response.content.splitlines())
+            except Exception, e:
+                log.debug("Unable to read %s/robots.txt: %s" % (host, e))
+                robots = False
+            with self.lock:
+                self.robots[host] = robots
+        return robots is False or robots.can_fetch(self.user_agent, url)
+
+    def wait_turn(self, host):
+        """ Sleep until it is polite to hit `host` again """
+        with self.lock:
+            now = time.time()
+            turn = max(now, self.next_visit.get(host, 0))
+            self.next_visit[host] = turn + self.delay
+            if host not in self.host_locks:
+                self.host_locks[host] = threading.BoundedSemaphore(
+                        self.host_pages)
+        if turn > now:
+            time.sleep(turn - now)
+        return self.host_locks[host]
+
+    def links(self, url):
+        """ Return the (link, soup_link) pairs on a page """
+        if not self.allowed(url):
+            log.info("robots.txt disallows %s" % url)
+            return []
+        with self.wait_turn(urlparse(url)[1]):
+            try:
+                soup = self.scraper.get_soup(url, parse_only=self.strainer,
+                                             html_only=True)
+            except NotHTML:
+                log.debug("Not crawling %s, which isn't HTML" % url)
+                return []
+            except Exception, e:
+                log.warning("Unable to crawl %s: %s" % (url, e))
+                return []
+        return [(urldefrag(urljoin(url, tag['href']))[0], tag)
+                for tag in soup.find_all('a', href=True)]
+
+    def crawl(self, url):
+        """ Yield a (link, soup_link) pair for every file found from `url` """
+        host = urlparse(url)[1]
+        self.visited.add(url)
+        level = [url]
+        pool = ThreadPool(self.workers)
+        try:
+            for depth in range(self.max_depth + 1):
+                frontier = []
+                for links in pool.imap(self.links, level):
+                    for link, tag in links:
+                        if self.is_file(link):
+                            if self.visited.add(link):
+                                yield link, tag
+                        elif (depth < self.max_depth and
+                              urlparse(link)[0] in ('http', 'https') and
+                              urlparse(link)[1] == host and
+                              self.visited.add(link)):
+                            if len(frontier) < self.max_frontier:
+                                frontier.append(link)
+                            else:
+                                log.debug("Frontier full, dropping %s" % link)
+                log.debug("Crawled depth %d of %s; %d pages next" % (
+                    depth, url, len(frontier)))
+                if not frontier:
+                    break
+                level = frontier
+        finally:
+            pool.terminate()
@@ -0,0 +1,172 @@
+"""
+Columnar exports of the polymorphic `civx_*` tables.
+
+A table is streamed out of the database in batches and written as a
+Parquet file, one row group per batch, so exporting a table of any size
+takes the same memory.  Exports are cached, and rebuilt once the data
+behind them changes:
+
+    >>> exports = ExportCache('/var/lib/civx/exports')
+    >>> exports.get(entity, DBSession)
+    '/var/lib/civx/exports/civx_0f3e...-5b7d0c2a91e4f3b6.parquet'
+
+Parquet support needs pyarrow, which is optional.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+from sqlalchemy import select
+
+from polyscraper import utils
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+log = logging.getLogger('PolyScraper')
+
+BATCH_SIZE = 65536
+
+
+class ExportError(Exception):
+    """ A table could not be exported """
+
+
+def arrow_type(kind):
+    """ Return the Arrow type of a column type from reader.infer_types """
+    return {
+        u'boolean': pyarrow.bool_(),
+        u'integer': pyarrow.int32(),
+        u'bigint': pyarrow.int64(),
+        u'float': pyarrow.float64(),
+        u'date': pyarrow.date32(),
+    }.get(kind, pyarrow.string())
+
+def field_names(entity):
+    """
+    Return a unique, non-empty name for each column of an entity's table,
+    from its column names.
+    """
+    names = []
+    seen = set()
+    for column, name in zip(entity[u'columns'], entity[u'column_names']):
+        name = name.strip() or column
+        if name in seen:
+            name = u'%s_%s' % (name, column)
+        seen.add(name)
+        names.append(name)
+    return names
+
+def export_key(entity):
+    """
+    Return a digest of everything an export of an entity's table depends
+    on: its table, columns, what was last loaded into it, and the changelog
+    of the scrapes that loaded it.
+    """
+    changelog = (u'changelog' in entity.facts and entity[u'changelog'] or
+                 utils.get_fact_from_parents(u'changelog', entity))
+    state = [entity[u'table_name'], entity[u'columns'],
+             entity[u'column_names'],
+             u'column_types' in entity.facts and entity[u'column_types'],
+             u'loaded_digest' in entity.facts and entity[u'loaded_digest'],
+             changelog]
+    return hashlib.sha1(json.dumps(state, sort_keys=True,
+                                   default=unicode)).hexdigest()
+
+def iter_batches(session, table, columns, batch_size=BATCH_SIZE):
+    """
+    Yield the rows of a table, in order, as lists of at most `batch_size`
+    tuples, without loading more than one batch at a time.
+    """
+    query = select([table.c[column] for column in columns])
+    query = query.order_by(table.c.id)
+    result = session.connection().execution_options(
+            stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+def write_parquet(entity, session, path, batch_size=BATCH_SIZE):
+    """
+    Stream an entity's table into a Parquet file at `path`, and return the
+    number of rows written.  The file only appears once it is complete.
+    """
+    if pyarrow is None:
+        raise ExportError("pyarrow is needed to export %s" % entity.name)
+    if u'table_name' not in entity.facts:
+        raise ExportError("%s has no table" % entity.name)
+
+    table = utils.get_table_from_entity(entity)
+    columns = entity[u'columns']
+    types = (u'column_types' in entity.facts and entity[u'column_types'] or
+             [u'text'] * len(columns))
+    schema = pyarrow.schema([pyarrow.field(name, arrow_type(kind))
+                             for name, kind in zip(field_names(entity),
+                                                   types)])
+
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, partial = tempfile.mkstemp(dir=dirname, suffix='.part')
+    os.close(fd)
+    count = 0
+    try:
+        writer = pyarrow.parquet.ParquetWriter(partial, schema,
+                                               compression='snappy')
+        try:
+            for rows in iter_batches(session, table, columns, batch_size):
+                arrays = [pyarrow.array(list(values), type=field.type)
+                          for values, field in zip(zip(*rows), schema)]
+                writer.write_table(pyarrow.Table.from_arrays(arrays,
+                                                             schema=schema))
+                count += len(rows)
+        finally:
+            writer.close()
+        os.rename(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.unlink(partial)
+    log.info("Exported %d rows of %s to %s" % (count, table.name, path))
+    return count
+
+
+class ExportCache(object):
+    """
+    Parquet exports of the polymorphic tables, kept under `path` and named
+    by table and export_key, so an export is rebuilt whenever anything it
+    depends on changes.
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+
+    def path_of(self, entity):
+        return os.path.join(self.path, '%s-%s.parquet' % (
+            entity[u'table_name'], export_key(entity)[:16]))
+
+    def get(self, entity, session):
+        """ Return the path of an up to date export of an entity's table """
+        path = self.path_of(entity)
+        if os.path.exists(path):
+            return path
+        write_parquet(entity, session, path, self.batch_size)
+
+        # Clear out the stale exports of this table
+        prefix = entity[u'table_name'] + '-'
+        for name in os.listdir(self.path):
+            stale = os.path.join(self.path, name)
+            if name.startswith(prefix) and stale != path:
+                os.unlink(stale)
+        return path
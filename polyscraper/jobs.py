@@ -0,0 +1,252 @@
+"""
+A queue of URLs to scrape, and a pool of worker processes to scrape them.
+
+    >>> queue = SQLiteQueue('/var/lib/civx/jobs.db')
+    >>> queue.push(u'http://www.data.gov/raw/994', priority=10)
+    >>> Runner(queue, 'postgresql://civx@localhost/civx', workers=4).run()
+
+Queues only need `push`, `pop` and `done`, so a broker adapter (for the
+`civx.scrapers.new_url` topic) can be dropped in for the in-memory or SQLite
+backends.  Each worker process owns its own engine and `DBSession`.
+"""
+
+import time
+import heapq
+import sqlite3
+import logging
+import itertools
+import multiprocessing
+
+from Queue import Empty
+from urlparse import urlparse
+
+log = logging.getLogger('PolyScraper')
+
+
+class MemoryQueue(object):
+    """ An in-process priority queue of URLs; higher priorities go first """
+
+    def __init__(self):
+        self.heap = []
+        self.queued = set()
+        self.running = set()
+        self.counter = itertools.count()
+
+    def push(self, url, priority=0):
+        """ Queue a URL, unless it is already queued or being scraped """
+        if url in self.queued or url in self.running:
+            return False
+        heapq.heappush(self.heap, (-priority, self.counter.next(), url))
+        self.queued.add(url)
+        return True
+
+    def pop(self):
+        """ Return the next URL to scrape, or None """
+        if not self.heap:
+            return None
+        url = heapq.heappop(self.heap)[2]
+        self.queued.discard(url)
+        self.running.add(url)
+        return url
+
+    def done(self, url, error=None):
+        """ Mark a URL as scraped """
+        self.running.discard(url)
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class SQLiteQueue(object):
+    """ A priority queue of URLs that survives restarts """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            url TEXT PRIMARY KEY,
+            priority INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'queued',
+            added REAL NOT NULL,
+            error TEXT)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS jobs_queued
+            ON jobs (state, priority, added)""")
+        # Anything left running by a dead process needs to run again
+        self.db.execute("UPDATE jobs SET state = 'queued' "
+                        "WHERE state = 'running'")
+
+    def push(self, url, priority=0):
+        """ Queue a URL, unless it is already queued or being scraped """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT state FROM jobs WHERE url = ?",
+                                  (url,)).fetchone()
+            if row and row[0] in ('queued', 'running'):
+                return False
+            self.db.execute("INSERT OR REPLACE INTO jobs "
+                            "(url, priority, state, added) "
+                            "VALUES (?, ?, 'queued', ?)",
+                            (url, priority, time.time()))
+            return True
+        finally:
+            self.db.execute("COMMIT")
+
+    def pop(self):
+        """ Return the next URL to scrape, or None """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT url FROM jobs WHERE state = 'queued' "
+                                  "ORDER BY priority DESC, added "
+                                  "LIMIT 1").fetchone()
+            if not row:
+                return None
+            self.db.execute("UPDATE jobs SET state = 'running' WHERE url = ?",
+                            row)
+            return row[0]
+        finally:
+            self.db.execute("COMMIT")
+
+    def done(self, url, error=None):
+        """ Mark a URL as scraped, or as failed if there was an error """
+        self.db.execute("UPDATE jobs SET state = ?, error = ? WHERE url = ?",
+                        (error and 'failed' or 'done', error, url))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM jobs "
+                               "WHERE state = 'queued'").fetchone()[0]
+
+
+def _worker(engine_url, config, worker, tasks, results):
+    """ Scrape URLs from `tasks` until told to stop """
+    from sqlalchemy import create_engine
+    from knowledge.model import init_model, DBSession
+    from polyscraper.poly import PolyScraper
+
+    init_model(create_engine(engine_url))
+    scraper = PolyScraper()
+    scraper.config.update(config)
+    for url in iter(tasks.get, None):
+        error = None
+        try:
+            scraper.consume(url)
+        except Exception, e:
+            log.exception(e)
+            error = unicode(e) or e.__class__.__name__
+            DBSession.rollback()
+        finally:
+            DBSession.remove()
+        results.put((worker, url, error))
+
+
+class Runner(object):
+    """
+    Feeds the URLs in a queue to a pool of `workers` scraper processes,
+    starting at most one scrape of each host every `host_delay` seconds.
+
+    URLs whose host isn't ready yet are set aside, up to `max_deferred` of
+    them, before the runner stops taking more off the queue.  A worker that
+    dies fails the URL it was scraping, and is replaced.
+    """
+
+    poll_interval = 1.0
+    max_deferred = 100
+
+    def __init__(self, queue, engine_url, workers=4, host_delay=1.0,
+                 config=None):
+        self.queue = queue
+        self.engine_url = engine_url
+        self.workers = workers
+        self.host_delay = host_delay
+        self.config = config or {}
+        self.last_start = {}
+        self.deferred = []
+        # A (process, tasks) pair for each worker, and the URL it's on
+        self.processes = []
+        self.running = {}
+
+    def start(self):
+        self.results = multiprocessing.Queue()
+        self.processes = [self.spawn(i) for i in range(self.workers)]
+
+    def spawn(self, worker):
+        """ Start a worker process, with its own queue of tasks """
+        tasks = multiprocessing.Queue()
+        # Not daemonic, as a scrape may load its CSV files with a
+        # process pool of its own; stop() shuts them down instead
+        process = multiprocessing.Process(target=_worker, args=(
+            self.engine_url, self.config, worker, tasks, self.results))
+        process.start()
+        return process, tasks
+
+    def stop(self):
+        for process, tasks in self.processes:
+            tasks.put(None)
+        for process, tasks in self.processes:
+            process.join()
+        self.processes = []
+
+    def next_url(self):
+        """ Return the next URL whose host is ready to be scraped, or None """
+        now = time.time()
+        for i, url in enumerate(self.deferred):
+            if self.ready(url, now):
+                return self.deferred.pop(i)
+        while len(self.deferred) < self.max_deferred:
+            url = self.queue.pop()
+            if url is None or self.ready(url, now):
+                return url
+            self.deferred.append(url)
+        return None
+
+    def ready(self, url, now):
+        host = urlparse(url)[1]
+        return now - self.last_start.get(host, 0) >= self.host_delay
+
+    def finished(self, url, error=None):
+        if error:
+            log.error("Failed to scrape %s: %s" % (url, error))
+        self.queue.done(url, error)
+
+    def reap(self):
+        """ Fail the URL of each worker that died, and replace the worker """
+        for i, (process, tasks) in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            log.warning("Worker %d exited with %s; restarting it" % (
+                i, process.exitcode))
+            url = self.running.pop(i, None)
+            if url is not None:
+                self.finished(url, u'Worker exited with %s' % process.exitcode)
+            self.processes[i] = self.spawn(i)
+
+    def run(self, forever=False):
+        """
+        Scrape everything in the queue, and keep waiting for more if
+        `forever` is set.
+        """
+        self.start()
+        try:
+            while True:
+                self.reap()
+                for i, (process, tasks) in enumerate(self.processes):
+                    if i in self.running:
+                        continue
+                    url = self.next_url()
+                    if url is None:
+                        break
+                    self.last_start[urlparse(url)[1]] = time.time()
+                    self.running[i] = url
+                    tasks.put(url)
+
+                if not self.running and not self.deferred and not forever:
+                    break
+                try:
+                    worker, url, error = self.results.get(
+                            timeout=self.poll_interval)
+                except Empty:
+                    continue
+                # Unless reap() already failed it
+                if self.running.get(worker) == url:
+                    del self.running[worker]
+                    self.finished(url, error)
+        finally:
+            self.stop()
@@ -0,0 +1,340 @@
+"""
+Bulk loading of rows into the polymorphic `civx_*` tables.
+
+PostgreSQL gets the rows through `COPY ... FROM STDIN`; every other dialect
+gets batched `executemany` inserts through SQLAlchemy Core.
+"""
+
+import time
+import struct
+import hashlib
+import logging
+
+from cStringIO import StringIO
+from sqlalchemy import Index, select
+
+from polyscraper.reader import converters, iter_batches, iter_rows, make_dialect
+
+log = logging.getLogger('PolyScraper')
+
+# Engines used by load_csv in worker processes
+_engines = {}
+
+def engine_url(engine):
+    """
+    Return the URL another process can use to connect to the same database
+    as `engine`, or None if it can't.
+    """
+    url = engine.url
+    if url.drivername.startswith('sqlite') and url.database in (None, '',
+                                                               ':memory:'):
+        return None
+    if hasattr(url, 'render_as_string'):
+        return url.render_as_string(hide_password=False)
+    return str(url)
+
+def fit_row(row, width, converters=None):
+    """
+    Pad or trim a row to `width` values, and convert them to their column
+    types with `converters` from reader.converters.  Anything that didn't
+    fit is returned separately so it can be kept in the graveyard column.
+    """
+    row = list(row)
+    graveyard = []
+    if len(row) < width:
+        row += [None] * (width - len(row))
+    elif len(row) > width:
+        graveyard.append(u','.join(row[width:]))
+        row = row[:width]
+    if converters:
+        for i, convert in enumerate(converters):
+            value = row[i]
+            if convert is None or value is None:
+                continue
+            if not value:
+                # Empty values in a typed column are NULL
+                row[i] = None
+                continue
+            try:
+                row[i] = convert(value)
+            except ValueError:
+                row[i] = None
+                graveyard.append(u'col_%d=%s' % (i, value))
+    return row, graveyard and u','.join(graveyard) or None
+
+class ColumnStats(object):
+    """
+    Counts the rows, and the empty and distinct values in each column, of
+    the rows loaded into a table.  Distinct values stop being counted once a
+    column has `max_distinct` of them, which is plenty to know it's worth
+    indexing.  They aren't counted at all for the text columns given
+    `types`, which are never indexed, so their values aren't held on to.
+    """
+
+    def __init__(self, width, max_distinct=10000, types=None):
+        self.rows = 0
+        self.nulls = [0] * width
+        self.values = [set() for i in range(width)]
+        self.skipped = set()
+        if types:
+            self.skipped = set(i for i, kind in enumerate(types)
+                               if kind == u'text')
+            for i in self.skipped:
+                self.values[i] = None
+        self.max_distinct = max_distinct
+
+    def add(self, row):
+        self.rows += 1
+        for i, value in enumerate(row):
+            if value is None or value == u'':
+                self.nulls[i] += 1
+                continue
+            values = self.values[i]
+            if values is not None:
+                values.add(value)
+                if len(values) >= self.max_distinct:
+                    self.values[i] = None
+
+    def summary(self):
+        """
+        Return the counts as a dict of `rows`, `nulls` and `distinct`, where
+        the distinct count of a skipped column is None.
+        """
+        distinct = []
+        for i, values in enumerate(self.values):
+            if i in self.skipped:
+                distinct.append(None)
+            elif values is None:
+                distinct.append(self.max_distinct)
+            else:
+                distinct.append(len(values))
+        return {'rows': self.rows, 'nulls': self.nulls, 'distinct': distinct}
+
+def merge_stats(summaries):
+    """
+    Combine the ColumnStats summaries of loads into the same table.  The
+    distinct counts can't be added up, so each is the largest of them.
+    """
+    summaries = list(summaries)
+    return {'rows': sum(s['rows'] for s in summaries),
+            'nulls': [sum(counts) for counts in
+                      zip(*[s['nulls'] for s in summaries])],
+            'distinct': [max(counts) for counts in
+                         zip(*[s['distinct'] for s in summaries])]}
+
+def selective_columns(columns, types, stats, min_rows=1000, min_distinct=20):
+    """
+    Return the columns worth indexing, given the `stats` summary of a load:
+    those that aren't free text, in tables of at least `min_rows` rows, with
+    enough distinct values that looking one up skips most of the table.
+    """
+    if not types or stats['rows'] < min_rows:
+        return []
+    return [column for column, kind, distinct in
+            zip(columns, types, stats['distinct'])
+            if kind != u'text' and distinct >= min_distinct]
+
+def create_indexes(session, table, columns):
+    """
+    Index `columns` of a table, once it has been loaded, and have the
+    database update its statistics for the query planner.
+    """
+    connection = session.connection()
+    for column in columns:
+        index = Index('ix_%s_%s' % (table.name, column), table.c[column])
+        index.create(bind=connection)
+    if connection.dialect.name in ('postgresql', 'sqlite'):
+        connection.execute('ANALYZE "%s"' % table.name)
+    log.info("Indexed %s on %s" % (table.name, ', '.join(columns) or 'nothing'))
+
+def copy_value(value):
+    """
+    Format a value for COPY's CSV format, where an unquoted \\N is NULL and
+    every string is quoted, so even an empty one stays a string.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return value and 'true' or 'false'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return '"%s"' % value.replace('"', '""')
+
+def copy_buffer(rows):
+    """ Return a buffer of rows to load with COPY ... (FORMAT csv) """
+    buf = StringIO()
+    for row in rows:
+        buf.write(','.join(copy_value(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    return buf
+
+def copy_rows(connection, table, columns, rows):
+    """ Load rows into a PostgreSQL table with COPY """
+    buf = copy_buffer(rows)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY "%s" (%s) FROM STDIN WITH '
+                           "(FORMAT csv, NULL '\\N')" % (
+                table.name, ', '.join('"%s"' % col for col in columns)), buf)
+    finally:
+        cursor.close()
+
+def insert_rows(connection, table, columns, rows):
+    """ Load rows into a table with an executemany INSERT """
+    connection.execute(table.insert(),
+                       [dict(zip(columns, row)) for row in rows])
+
+def bulk_load(session, table, columns, batches, types=None, stats=None,
+              commit=False):
+    """
+    Load an iterable of row batches into `table`.  Each row is a sequence of
+    values for `columns`, which are converted to `types` if given, and
+    counted in the ColumnStats `stats` if given.  Returns the number of rows
+    loaded.
+
+    The rows are loaded in the session's transaction, so they can be rolled
+    back along with the rest of a file's work, unless `commit` is set, when
+    each batch is committed as it is loaded.
+    """
+    columns = list(columns) + ['graveyard']
+    width = len(columns) - 1
+    convert = types and converters(types)
+    if session.connection().dialect.name == 'postgresql':
+        load = copy_rows
+    else:
+        load = insert_rows
+
+    start = time.time()
+    count = 0
+    for batch in batches:
+        fitted_batch = []
+        for row in batch:
+            fitted, graveyard = fit_row(row, width, convert)
+            if stats:
+                stats.add(fitted)
+            fitted.append(graveyard)
+            fitted_batch.append(fitted)
+        batch = fitted_batch
+        load(session.connection(), table, columns, batch)
+        if commit:
+            session.commit()
+        count += len(batch)
+        log.debug("Loaded %d rows into %s" % (count, table.name))
+
+    elapsed = time.time() - start
+    log.info("Loaded %d rows into %s in %.2fs (%d rows/sec)" % (
+        count, table.name, elapsed, count / (elapsed or 1e-9)))
+    return count
+
+def copy_table(session, source, target):
+    """
+    Copy every row of the table `source` into `target`, an empty table with
+    the same columns, in the session's transaction.  Returns the number of
+    rows copied.
+    """
+    columns = [column.name for column in source.columns]
+    result = session.connection().execute(target.insert().from_select(
+        columns, select([source.c[column] for column in columns])))
+    return result.rowcount
+
+def row_hash(row):
+    """ Return a 64 bit digest identifying a row's values """
+    return struct.unpack('<q', hashlib.sha1(u'\x1f'.join(
+        value is None and u'\x00' or unicode(value)
+        for value in row).encode('utf-8')).digest()[:8])[0]
+
+def sync_rows(session, table, columns, rows, transaction_size=1000,
+              types=None):
+    """
+    Make `table` hold exactly `rows`, by inserting the rows it is missing and
+    deleting the ones that are gone.  Rows that didn't change are left
+    alone.  Everything happens in the session's transaction.  Returns an
+    (inserted, deleted) tuple.
+
+    The row_hash and id of every row in the table are held in memory while
+    the rows are compared, which is around 100 bytes a row; the rows
+    themselves are streamed.
+    """
+    width = len(columns)
+    convert = types and converters(types)
+    query = select([table.c.id] + [table.c[col] for col in columns] +
+                   [table.c.graveyard])
+    # The id of each row, or a list of ids for rows that appear more than
+    # once, by row_hash
+    existing = {}
+    result = session.connection().execution_options(
+            stream_results=True).execute(query)
+    for row in result:
+        key = row_hash(row[1:])
+        ids = existing.get(key)
+        if ids is None:
+            existing[key] = row[0]
+        elif isinstance(ids, list):
+            ids.append(row[0])
+        else:
+            existing[key] = [ids, row[0]]
+
+    def added():
+        for row in rows:
+            # Compare typed values, as they come back from the table
+            fitted, graveyard = fit_row(row, width, convert)
+            key = row_hash(fitted + [graveyard])
+            ids = existing.pop(key, None)
+            if ids is None:
+                yield row
+            elif isinstance(ids, list):
+                ids.pop()
+                existing[key] = len(ids) > 1 and ids or ids[0]
+
+    inserted = bulk_load(session, table, columns,
+                         iter_batches(added(), transaction_size), types)
+
+    gone = []
+    for ids in existing.itervalues():
+        if isinstance(ids, list):
+            gone.extend(ids)
+        else:
+            gone.append(ids)
+    for i in range(0, len(gone), transaction_size):
+        session.connection().execute(table.delete().where(
+            table.c.id.in_(gone[i:i + transaction_size])))
+    log.info("Removed %d rows from %s" % (len(gone), table.name))
+    return inserted, len(gone)
+
+def load_csv(url, table_name, columns, filename, dialect, encoding,
+             transaction_size=1000, types=None, offset=0, end=None):
+    """
+    Load a CSV file, minus its header, into an existing table from a worker
+    process.  `dialect` holds the format parameters from
+    reader.dialect_params, and `types` the column types from
+    reader.infer_types.  Only the records between bytes `offset` and `end`
+    are loaded, if given, as split up by reader.split_ranges.  Each batch is
+    committed as it is loaded.  Returns the number of rows loaded, and a
+    ColumnStats summary of them.
+    """
+    from sqlalchemy import MetaData, Table, create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    if url not in _engines:
+        _engines[url] = create_engine(url)
+    engine = _engines[url]
+    table = Table(table_name, MetaData(), autoload=True, autoload_with=engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        rows = iter_rows(filename, make_dialect(dialect), encoding, offset, end)
+        if not offset:
+            rows.next()
+        stats = ColumnStats(len(columns), types=types)
+        count = bulk_load(session, table, columns,
+                          iter_batches(rows, transaction_size), types, stats,
+                          commit=True)
+        return count, stats.summary()
+    finally:
+        session.close()
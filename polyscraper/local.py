@@ -0,0 +1,97 @@
+"""
+Helpers for ingesting files that are already on the local filesystem.
+"""
+
+import os
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Linux's clone-a-file ioctl, for copy-on-write filesystems
+FICLONE = 0x40049409
+
+def iter_files(path):
+    """
+    Lazily yield a (filename, stat) pair for every file under `path`, which
+    may itself be a file.
+    """
+    if not os.path.isdir(path):
+        yield path, os.stat(path)
+        return
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                filename = os.path.join(dirpath, filename)
+                yield filename, os.stat(filename)
+        return
+    directories = [path]
+    while directories:
+        for entry in scandir(directories.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+            elif entry.is_file():
+                yield entry.path, entry.stat()
+
+def link_or_copy(src, dst):
+    """
+    Put `src` at `dst` as cheaply as possible: a hard link if they're on
+    the same filesystem, then a reflink, and only then a real copy.
+    Returns which one it used.
+
+    Only hard link files the scraper owns, like its stored blobs: anything
+    that writes to `dst` in place would write to `src` too.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        pass
+    return clone_or_copy(src, dst)
+
+def clone_or_copy(src, dst):
+    """
+    Put a copy of `src` at `dst` that doesn't share its data: a reflink on
+    copy-on-write filesystems, and otherwise a real copy.  Returns which
+    one it used.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        import fcntl
+        with open(src, 'rb') as source:
+            with open(dst, 'wb') as clone:
+                fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+        return 'reflink'
+    except (ImportError, IOError, OSError):
+        pass
+    shutil.copy(src, dst)
+    return 'copy'
+
+@contextmanager
+def replacing(path, mode='wb'):
+    """
+    Write a file at `path` through a temporary file that is renamed over
+    it once complete.  Files in the repos can be links to the blob store,
+    so writing to them in place would change every copy at once.
+    """
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, mode) as out:
+            yield out
+        os.chmod(partial, 0644)
+        os.rename(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.unlink(partial)
@@ -0,0 +1,165 @@
+"""
+Timers and counters for each stage of a scrape.
+
+    >>> metrics = Metrics()
+    >>> with metrics.timer('fetch'):
+    ...     fetch()
+    >>> metrics.count('fetch', bytes=4096)
+    >>> metrics.emit([PrometheusFile('/var/lib/node_exporter/polyscraper.prom'),
+    ...               StatsD('localhost:8125')])
+
+The stages are fetch, parse, magic, extract, csv, load and commit.  Stages
+nest (a load happens inside the magic handler of its file), so their times
+overlap rather than adding up to the whole scrape.
+"""
+
+import os
+import time
+import socket
+import logging
+import tempfile
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+log = logging.getLogger('PolyScraper')
+
+
+class Metrics(object):
+    """ The time spent in, and the calls, bytes and rows of, each stage """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.seconds = defaultdict(float)
+            self.counts = defaultdict(lambda: defaultdict(int))
+
+    @contextmanager
+    def timer(self, stage):
+        """ Time a block of code as one call of `stage` """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.seconds[stage] += elapsed
+                self.counts[stage]['calls'] += 1
+
+    def count(self, stage, **counts):
+        """ Add to the counters of a stage, such as its bytes or rows """
+        with self.lock:
+            for name, value in counts.items():
+                self.counts[stage][name] += value or 0
+
+    def summary(self):
+        """ Return {stage: {'seconds': ..., 'calls': ..., ...}} """
+        with self.lock:
+            summary = {}
+            for stage in set(self.seconds) | set(self.counts):
+                counts = dict((unicode(name), value) for name, value in
+                              self.counts[stage].items())
+                counts[u'seconds'] = round(self.seconds[stage], 3)
+                summary[unicode(stage)] = counts
+            return summary
+
+    def emit(self, sinks):
+        """ Send the summary to each sink, without letting one fail us """
+        summary = self.summary()
+        for sink in sinks:
+            try:
+                sink.emit(summary)
+            except Exception, e:
+                log.warning("Unable to send metrics to %r: %s" % (sink, e))
+
+
+class PrometheusFile(object):
+    """
+    Keeps running totals of every scrape in this process, in the text format
+    the node_exporter textfile collector reads.  Give each process its own
+    file.
+    """
+
+    def __init__(self, path, prefix='polyscraper'):
+        self.path = path
+        self.prefix = prefix
+        self.totals = defaultdict(float)
+        self.scrapes = 0
+
+    def emit(self, summary):
+        self.scrapes += 1
+        for stage, counts in summary.items():
+            for name, value in counts.items():
+                self.totals[(name, stage)] += value
+
+        lines = ['# TYPE %s_scrapes_total counter' % self.prefix,
+                 '%s_scrapes_total %d' % (self.prefix, self.scrapes),
+                 '# TYPE %s_last_scrape_timestamp_seconds gauge' % self.prefix,
+                 '%s_last_scrape_timestamp_seconds %d' % (self.prefix,
+                                                          time.time())]
+        for name in sorted(set(name for name, stage in self.totals)):
+            metric = '%s_stage_%s_total' % (self.prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            for stage in sorted(stage for n, stage in self.totals if n == name):
+                lines.append('%s{stage="%s"} %s' % (
+                    metric, stage, repr(self.totals[(name, stage)])))
+
+        # Write it atomically, so the collector never reads half a file
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.metrics')
+        with os.fdopen(fd, 'w') as out:
+            out.write('\n'.join(lines) + '\n')
+        os.chmod(tmp, 0644)
+        os.rename(tmp, self.path)
+
+    def __repr__(self):
+        return 'PrometheusFile(%r)' % self.path
+
+
+class StatsD(object):
+    """ Sends each scrape's stage timings and counts to a StatsD daemon """
+
+    def __init__(self, address='localhost:8125', prefix='polyscraper'):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, summary):
+        packet = []
+        for stage, counts in sorted(summary.items()):
+            for name, value in sorted(counts.items()):
+                if name == u'seconds':
+                    packet.append('%s.%s.time:%d|ms' % (self.prefix, stage,
+                                                        value * 1000))
+                else:
+                    packet.append('%s.%s.%s:%d|c' % (self.prefix, stage,
+                                                     name, value))
+        # Stay under a typical MTU
+        while packet:
+            size, chunk = 0, []
+            while packet and size + len(packet[0]) < 1400:
+                size += len(packet[0]) + 1
+                chunk.append(packet.pop(0))
+            chunk = chunk or [packet.pop(0)]
+            self.socket.sendto('\n'.join(chunk), self.address)
+
+    def __repr__(self):
+        return 'StatsD(%s:%d)' % self.address
+
+
+def sinks_from_config(config):
+    """
+    Build the sinks named in a scraper's config: `metrics_prometheus`, the
+    path of a file to write, and `metrics_statsd`, a StatsD host:port.
+    """
+    sinks = []
+    if config.get('metrics_prometheus'):
+        sinks.append(PrometheusFile(config['metrics_prometheus']))
+    if config.get('metrics_statsd'):
+        sinks.append(StatsD(config['metrics_statsd']))
+    return sinks
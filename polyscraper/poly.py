@@ -38,9 +38,6 @@ How it works
  * Datasets can be viewed in the PolyGrid (via /widgets/polygrid?model=<filename>)
 
 TODO:
- * Make sure it only populates the *new* data from git!!
-    we've got duplicate tables getting created now
-
  * Datasets profiles are created
     - dataset is self documenting
  * Data is visualized in grids
@@ -65,9 +62,13 @@ import re
 import os
 import csv
 import shutil
+import hashlib
 import logging
 import uuid
-import subprocess
+import itertools
+import multiprocessing
+
+from itertools import izip
 
 from twill.commands import fv, save_html, submit
 from datetime import datetime
@@ -79,8 +80,11 @@ from knowledge.model import Fact, Entity, DBSession
 
 from bs4 import BeautifulSoup
 
-from polyscraper import utils
-from polyscraper.scraper import Scraper
+from polyscraper import (archive, cache, export, loader, local, metrics,
+                         reader, session, utils)
+from polyscraper.blobs import BlobStore
+from polyscraper.crawler import Crawler
+from polyscraper.scraper import PARSER, Scraper
 
 extensions = u'csv,zip,exe,xls,txt,rss,xml,json'
 
@@ -89,7 +93,44 @@ class PolyScraper(Scraper):
 
     def __init__(self):
         self.log = logging.getLogger('PolyScraper')
-        self.config = {'git_dir': '/tmp/git'}
+        self.config = {
+            'git_dir': '/tmp/git',
+            'download_workers': 8,  # parallel downloads per scrape
+            'host_downloads': 2,    # parallel downloads per host
+            'chunk_size': 64 * 1024,
+            'download_retries': 3,
+            'transaction_size': 1000,  # rows per bulk load batch
+            'extract_workers': 4,      # threads per zip extraction
+            'entity_cache_persist': False,  # keep entities between scrapes
+            'flush_every': 100,        # entities per session flush
+            'flush_interval': 1000,    # or milliseconds between flushes
+            'crawl_depth': 2,          # links to follow from a generic url
+            'crawl_workers': 4,
+            'crawl_delay': 1.0,        # seconds between pages from a host
+            'ingest_processes': multiprocessing.cpu_count(),
+            'ingest_chunk': 1000,      # local files handled at a time
+            'type_sample_rows': 10000, # rows to infer column types from
+            'index_min_rows': 1000,    # smaller tables aren't indexed
+            'index_min_distinct': 20,  # values a column needs to be indexed
+            'split_bytes': 256 * 1024 * 1024,  # CSVs loaded by several workers
+        }
+        # (dialect, encoding) of the CSV files in each repo
+        self.sniffed = {}
+        # Handlers for each magic string we've seen
+        self._magic_handlers = None
+        self.entities = cache.EntityCache()
+        self.uow = session.UnitOfWork(DBSession, self.config)
+        # Worker processes loading CSV files during local ingestion
+        self.load_pool = None
+        self.pending_loads = []
+        # Timers and counters for each stage, and where to send them
+        self.metrics = metrics.Metrics()
+        self.metric_sinks = None
+
+    @property
+    def blobs(self):
+        """ One copy of every distinct file we've downloaded """
+        return BlobStore(os.path.join(self.config['git_dir'], '.blobs'))
 
     def consume(self, url):
         """
@@ -106,6 +147,9 @@ class PolyScraper(Scraper):
         """
         self.log.debug("PolyScraper(%s)" % url)
         start = datetime.utcnow()
+        self.metrics.reset()
+        if not self.config.get('entity_cache_persist'):
+            self.entities.clear()
 
         # Try to pull a protocol off the URI
         protocol_end = url.find("://")
@@ -120,17 +164,17 @@ class PolyScraper(Scraper):
             hostname = u"localhost"
 
         # See if we already know about this URL
-        entity = Entity.by_name(url)
+        entity = self.entities.get(url)
         if entity:
             self.log.info('Entity(%r) already exists' % url)
         else:
-            root = Entity.by_name(u'CIVX')
+            root = self.entities.get(u'CIVX')
             if not root:
                 root = Entity(name=u'CIVX')
                 DBSession.add(root)
                 DBSession.flush()
 
-            parent = Entity.by_name(hostname)
+            parent = self.entities.get(hostname)
             if not parent:
                 parent = Entity(name=hostname)
                 DBSession.add(parent)
@@ -154,7 +198,7 @@ class PolyScraper(Scraper):
         #entity[u'url'] = url
 
         # Initialize the git repository for this domain
-        #~ self.init_git_repo(repo=hostname)
+        self.init_git_repo(repo=hostname)
         DBSession.flush()
 
         # Scrape the url (to a certain depth) for data
@@ -177,58 +221,7 @@ class PolyScraper(Scraper):
                 self.log.debug("FTP support is not implemented yet.")
             elif protocol == "file":
                 search_path = url[protocol_end+3:]
-                local_files = []
-                if os.path.isdir(search_path):
-                    # Find all files in directory
-                    for directory in os.walk(search_path):
-                        dirpath = directory[0]
-                        for filename in directory[2]:
-                            local_files.append(os.path.join(dirpath, filename))
-                else:
-                    local_files.append(search_path)
-
-                dest = os.path.join(self.config['git_dir'], hostname)
-
-                # FIXME: what about for links to epa.gov from data.gov?
-                # we probably want our own epa.gov repo namespace to download
-                # and extract this to
-                #if not os.path.isdir(dest):
-                #    self.log.debug("mkdir %s" % dest)
-                #    os.makedirs(dest)
-
-                # I think this section is deprecated and unnecessary...
-                #for ext in extensions.split(','):
-                ##    if link.endswith('%s' % ext) or '/%s/' % ext in link:
-                ##        entity[u'format'] = ext
-                #    if ext not in civx.model.models[Entity]:
-                #        civx.model.models[Entity][ext] = []
-
-                for path in local_files:
-                    #raw = self.download_file(link)
-                    #file_name = os.path.basename(link)
-                    #filename = to_unicode(os.path.join(dest, file_name))
-                    #num_downloads += 1
-
-                    #shutil.copy(raw, filename)
-                    #self.log.debug("Copied %s to %s" % (raw,
-                    #    os.path.join(dest, file_name)))
-
-                    ##file_entity = Entity(name=os.path.basename(file_name))
-                    #file_entity = Entity(name=link)
-                    ##file_entity[u'url'] = link
-                    #file_entity[u'filename'] = filename
-                    #file_entity[u'repo'] = hostname
-                    #DBSession.add(file_entity)
-                    #file_entity.parent = entity
-                    ##file_entity.parent = parent
-                    #self.log.debug("Created entity %r (parent %r)" % (
-                    #    file_entity.name, file_entity.parent.name))
-
-                    file_path = os.path.split(path)[0]
-                    file_name = os.path.split(path)[1]
-                    self.log.info("%s is a local file" % file_name)
-                    files.append((file_path, file_name, path))
-                    #files.append((os.path.dirname(filename), file_name, filename))
+                num_downloads += self.ingest_local(search_path, entity, hostname)
 
             else:
                 # Assume protocol is http
@@ -242,24 +235,34 @@ class PolyScraper(Scraper):
                 # throw file at magic handlers
 ####
 """
-                soup = self.get_soup(url)
-
                 for link, soup_link in self.scrape_files_from_url(url, soup_links=True):
                     parsed_link = urlparse(link)
                     file_path = '/'.join(parsed_link[2].split('/')[:-1])
                     file_name = parsed_link[2].split('/')[-1]
                     files.append((file_path, file_name, link))
 
+            # Look up all of the files we already know about at once
+            self.entities.warm([link for _, _, link in files])
+
+            pending = []
+            destinations = set()
             for (file_path, file_name, link) in files:
-                dest = self.config['git_dir'] + hostname + file_path
-                local = os.path.exists(link)
+                dest = os.path.join(self.config['git_dir'], hostname,
+                                    file_path.lstrip('/'))
 
                 # See if this file already exists
-                file_entity = Entity.by_name(link)
+                file_entity = self.entities.get(link)
                 #file_entity = Entity.by_name(os.path.basename(file_name))
+                validators = {}
                 if file_entity:
-                    self.log.info('Entity(%r) already exists; skipping.' % link)
-                    continue
+                    if os.path.exists(link):
+                        self.log.info('Entity(%r) already exists; skipping.' % link)
+                        continue
+                    # Only download it again if it changed upstream
+                    self.log.info('Entity(%r) already exists; revalidating.' % link)
+                    for key in (u'etag', u'last_modified'):
+                        if key in file_entity.facts:
+                            validators[key] = file_entity[key]
 
                 # FIXME: what about for links to epa.gov from data.gov?
                 # we probably want our own epa.gov repo namespace to download
@@ -267,38 +270,54 @@ class PolyScraper(Scraper):
                 if not os.path.isdir(dest):
                     os.makedirs(dest)
 
-                # I think this section is deprecated and unnecessary...
-                for ext in extensions.split(','):
-                #    if link.endswith('%s' % ext) or '/%s/' % ext in link:
-                #        entity[u'format'] = ext
-                    if ext not in civx.model.models[Entity]:
-                        civx.model.models[Entity][ext] = []
-
-                raw = self.download_file(link)
+                # Links to the same path, like ?year=2010 and ?year=2011,
+                # each get a file of their own
                 filename = os.path.join(dest, file_name)
+                if urlparse(link).query or filename in destinations:
+                    root, ext = os.path.splitext(file_name)
+                    filename = os.path.join(dest, '%s-%s%s' % (root,
+                            hashlib.sha1(link.encode('utf-8')).hexdigest()[:8],
+                            ext))
+                destinations.add(filename)
+
+                pending.append((link, filename, validators))
+
+            # Fetch everything in parallel, but create the entities and run
+            # the magic handlers here, in order, on the session's thread.
+            for link, filename, validators in self.download_files(pending):
+                if filename is None:
+                    continue
                 num_downloads += 1
 
-                if local:
-                    self.log.debug("Copied %s to %s" % (raw, filename))
-                    shutil.copy(raw, filename)
-                else:
-                    self.log.debug("Moved %s to %s" % (raw, filename))
-                    shutil.move(raw, filename)
-
-                #file_entity = Entity(name=os.path.basename(file_name))
-                file_entity = Entity(name=link)
-                #file_entity[u'url'] = link
-                file_entity[u'filename'] = filename
-                file_entity[u'repo'] = hostname
-                DBSession.add(file_entity)
-                file_entity.parent = entity
-                #file_entity.parent = parent
-                self.log.debug("Created entity %r (parent %r)" % (
-                    file_entity.name, file_entity.parent.name))
-
-                # Determine the file magic, and call the appropriate handler
-                file_entity[u'magic'] = self.call_magic_handler(filename, file_entity)
-                DBSession.flush()
+                # A file that fails to process only rolls back itself
+                with self.uow.savepoint(link):
+                    file_entity = self.entities.get(link)
+                    if not file_entity:
+                        #file_entity = Entity(name=os.path.basename(file_name))
+                        file_entity = Entity(name=link)
+                        #file_entity[u'url'] = link
+                        file_entity[u'repo'] = hostname
+                        DBSession.add(file_entity)
+                        file_entity.parent = entity
+                        #file_entity.parent = parent
+                        self.log.debug("Created entity %r (parent %r)" % (
+                            file_entity.name, file_entity.parent.name))
+                    file_entity[u'filename'] = filename
+
+                    # Remember how to ask the server whether it has changed
+                    digest = validators.pop(u'sha1', None)
+                    for key, value in validators.items():
+                        file_entity[key] = value
+
+                    if self.dedup_file(filename, file_entity, digest):
+                        self.log.info("%s was already parsed" % link)
+                    else:
+                        # Determine the file magic, and call the appropriate handler
+                        file_entity[u'magic'] = self.call_magic_handler(filename, file_entity)
+                    self.uow.added()
+
+            with self.metrics.timer('commit'):
+                self.uow.flush()
 
 # To do this stuff we'll need to return an entity from the url handler?
         #if 'num_files' in entity.facts:
@@ -318,6 +337,9 @@ class PolyScraper(Scraper):
         if 'changelog' not in entity.facts:
             entity[u'changelog'] = []
 
+        # Commit everything we scraped to git, in one go
+        self.git_commit(u'Scraped %s' % url)
+
         finish = datetime.utcnow()
 
         changelog = {
@@ -326,185 +348,485 @@ class PolyScraper(Scraper):
             u'elapsed_time': unicode(finish-start),
             u'num_downloads': num_downloads,
             #u'num_children': len(entity.children),
-            #~ u'git_commit': self.get_latest_commit_id(),
+            u'git_commit': self.get_latest_commit_id(),
+            u'metrics': self.metrics.summary(),
             }
-        entity[u'changelog'].append(changelog)
+        # The changelog is pickled, so appending to it in place would go
+        # unnoticed; store a new list instead
+        entity[u'changelog'] = entity[u'changelog'] + [changelog]
 
-        DBSession.commit()
+        with self.metrics.timer('commit'):
+            DBSession.commit()
 
         self.log.info("== Statistics ==")
         self.log.info("Scraped url: " + url)
         self.log.info("Number of downloaded files: %d" % num_downloads)
+        for stage, counts in sorted(changelog[u'metrics'].items()):
+            self.log.info("%s: %s" % (stage, ', '.join('%s %s' % (value, name)
+                          for name, value in sorted(counts.items()))))
+        if self.metric_sinks is None:
+            self.metric_sinks = metrics.sinks_from_config(self.config)
+        self.metrics.emit(self.metric_sinks)
 
         #self.send_message('civx.knowledge.entitites.%s' % url, {
         #    'msg': 'Completed scraping %s' % url,
         #    'changelog': changelog,
         #    })
 
-    # File type handlers
-    def zip_exe_handler(self, entity):
-        """ Handles self-extracting zip files """
-        self.log.debug("zip_exe_handler(%s)" % entity)
-        entity[u'format'] = u'zip'
-        dirname = os.path.dirname(entity[u'filename'])
-        p = subprocess.Popen('unzip -o "%s"' % entity[u'filename'],
-                             shell=True, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             cwd=dirname)
-        out, err = p.communicate()
-        if err:
-            self.log.error("Error unzipping: " + err)
-        else:
-            # Delete compressed data after extracting
-            os.unlink(entity[u'filename'])
-
-        for line in out.split('\n'):
-            if line.strip().startswith('inflating'):
-                extracted = os.path.join(dirname, line.strip().split()[-1])
-                self.log.debug("extracted " + extracted)
-                magic = utils.get_magic(extracted)
-
-                # Create a new child Entity for each extracted file
-                extracted = to_unicode(extracted)
-                child = Entity.by_name(extracted)
-                if not child:
-                    child = Entity(name=os.path.basename(extracted))
-                    child[u'filename'] = extracted
-                    DBSession.add(child)
-                    child.parent = entity
-                    child[u'magic'] = to_unicode(magic)
-                    self.log.debug("Created %s" % child)
+    def dedup_file(self, filename, file_entity, digest=None):
+        """
+        Keep a single copy of a downloaded file in the blob store.  If the
+        same contents have already been parsed into a table, for this entity
+        or another one, give this entity a copy of that table and return
+        True so the file isn't parsed again.  Each entity has a table of its
+        own, as later changes to one file mustn't show up in the other.
+        """
+        if digest is None:
+            digest = utils.file_digest(filename)
+        previous = (u'sha1' in file_entity.facts and file_entity[u'sha1'])
+        file_entity[u'sha1'] = digest
+        if not self.blobs.store(filename, digest):
+            return False
+
+        if previous == digest and u'table_name' in file_entity.facts:
+            # Already in the repo, as of an earlier scrape
+            return True
+        self.git_add(filename)
+        for fact in DBSession.query(Fact).filter_by(key=u'sha1',
+                                                    char_value=digest):
+            twin = fact.entity
+            if twin is not file_entity and u'table_name' in twin.facts:
+                for key in (u'magic', u'columns', u'column_names',
+                            u'column_types', u'loaded_bytes',
+                            u'loaded_digest', u'row_count', u'column_nulls',
+                            u'column_distinct', u'indexed_columns'):
+                    if key in twin.facts:
+                        file_entity[key] = twin[key]
+                file_entity[u'table_name'] = (u'civx_' +
+                        unicode(uuid.uuid4()).replace('-', ''))
+                table = utils.get_table_from_entity(file_entity)
+                table.create(bind=DBSession.connection(), checkfirst=True)
+                with self.metrics.timer('load'):
+                    count = loader.copy_table(DBSession,
+                            utils.get_table_from_entity(twin), table)
+                    loader.create_indexes(DBSession, table,
+                            u'indexed_columns' in file_entity.facts and
+                            file_entity[u'indexed_columns'] or [])
+                self.metrics.count('load', rows=count)
+                self.log.info("Copied %d rows of %s into %s" % (
+                        count, twin[u'table_name'], table.name))
+                return True
+        return False
+
+    def ingest_local(self, search_path, entity, hostname):
+        """
+        Ingest a local file, or every file under a local directory, and
+        return how many files were ingested.
+
+        Files are walked lazily and handled `ingest_chunk` at a time.  Files
+        whose size and mtime match their entity are skipped, the rest are
+        reflinked into the repo rather than copied where possible.  Their magic
+        is found, and their CSV data loaded unless the database is SQLite,
+        by a pool of `ingest_processes` worker processes.
+        """
+        dest = os.path.join(self.config['git_dir'], hostname)
+        pool = self.process_pool(self.config.get('ingest_processes',
+                                                 multiprocessing.cpu_count()))
+        if pool and self.parallel_loads():
+            self.load_pool = pool
+
+        ingested = 0
+        files = local.iter_files(search_path)
+        try:
+            while True:
+                chunk = list(itertools.islice(files,
+                        self.config.get('ingest_chunk', 1000)))
+                if not chunk:
+                    break
+                self.entities.warm([unicode(path) for path, stat in chunk])
+
+                changed = []
+                for path, stat in chunk:
+                    link = unicode(path)
+                    file_entity = self.entities.get(link)
+                    if (file_entity and u'size' in file_entity.facts and
+                        file_entity[u'size'] == stat.st_size and
+                        file_entity[u'mtime'] == int(stat.st_mtime)):
+                        self.log.debug('%s has not changed; skipping.' % link)
+                        continue
+
+                    filename = os.path.join(dest, path.lstrip(os.sep))
+                    if not os.path.isdir(os.path.dirname(filename)):
+                        os.makedirs(os.path.dirname(filename))
+                    # Never a hard link, which would let anything we write
+                    # into the repo change the original
+                    how = local.clone_or_copy(path, filename)
+                    self.log.debug("Used a %s for %s" % (how, path))
+                    changed.append((link, unicode(filename), stat))
+
+                filenames = [filename for link, filename, stat in changed]
+                if pool:
+                    magics = pool.imap(utils.get_magic, filenames)
                 else:
-                    child.parent = entity
+                    magics = itertools.imap(utils.get_magic, filenames)
+
+                for (link, filename, stat), magic in izip(changed, magics):
+                    with self.uow.savepoint(link):
+                        file_entity = self.entities.get(link)
+                        if not file_entity:
+                            file_entity = Entity(name=link)
+                            file_entity[u'filename'] = filename
+                            file_entity[u'repo'] = hostname
+                            DBSession.add(file_entity)
+                            file_entity.parent = entity
+                            self.log.info("%s is a local file" % link)
+                        file_entity[u'size'] = stat.st_size
+                        file_entity[u'mtime'] = int(stat.st_mtime)
+                        file_entity[u'magic'] = self.call_magic_handler(
+                                filename, file_entity, magic)
+                        self.uow.added()
+                    ingested += 1
+            with self.metrics.timer('commit'):
+                self.uow.flush()
+        finally:
+            self.load_pool = None
+            if pool:
+                pool.close()
+                pool.join()
+            self.finish_loads()
+        return ingested
+
+    def process_pool(self, processes):
+        """
+        Return a pool of `processes` worker processes, or None if there's no
+        point in one, or we're running in a daemonic process, which isn't
+        allowed to have children.  The work is done inline instead.
+        """
+        if processes <= 1 or multiprocessing.current_process().daemon:
+            return None
+        return multiprocessing.Pool(processes)
 
-                DBSession.flush()
+    def finish_loads(self):
+        """
+        Wait for the CSV loads running in worker processes, and index the
+        tables they loaded.
+        """
+        for entity, results in self.pending_loads:
+            table_name = entity[u'table_name']
+            try:
+                self.wait_loads(entity, results)
+                DBSession.commit()
+            except Exception, e:
+                self.log.error("Unable to load %r" % table_name)
+                self.log.exception(e)
+                DBSession.rollback()
+        self.pending_loads = []
+
+    def wait_loads(self, entity, results):
+        """
+        Wait for the worker processes loading a CSV file entity's table,
+        each from its own range of the file, then index it and mark it
+        loaded.
+        """
+        count, stats = 0, []
+        for result in results:
+            loaded, summary = result.get()
+            count += loaded
+            stats.append(summary)
+        self.metrics.count('load', rows=count)
+        self.log.info("%d entries in %r table" % (count, entity[u'table_name']))
+        self.index_table(entity, utils.get_table_from_entity(entity),
+                         loader.merge_stats(stats))
+        self.mark_loaded(entity)
+
+    def mark_loaded(self, entity):
+        """
+        Remember how much of a CSV file entity has been loaded, so the next
+        scrape can pick up where this one left off.  Only call this once
+        the load has succeeded.
+        """
+        entity[u'loaded_bytes'] = os.path.getsize(entity[u'filename'])
+        entity[u'loaded_digest'] = utils.file_digest(entity[u'filename'])
+
+    def parallel_loads(self):
+        """
+        Return whether CSV files can be loaded by worker processes: the
+        database has to be reachable from them, and take more than one
+        writer at a time, which SQLite doesn't.
+        """
+        bind = DBSession.get_bind()
+        return bind.dialect.name != 'sqlite' and bool(loader.engine_url(bind))
+
+    def split_csv(self, entity, dialect):
+        """
+        Return the byte ranges of a CSV file entity to load in parallel, or
+        None if it is smaller than `split_bytes`, or the database can't take
+        more than one load at a time.
+        """
+        filename = entity[u'filename']
+        split_bytes = self.config.get('split_bytes')
+        if not split_bytes or os.path.getsize(filename) < split_bytes:
+            return None
+        if not self.parallel_loads():
+            return None
+        with self.metrics.timer('csv'):
+            ranges = reader.split_ranges(filename, dialect,
+                    self.config.get('ingest_processes', 1) * 2)
+        self.log.info("Loading %s in %d parts" % (filename, len(ranges)))
+        return len(ranges) > 1 and ranges or None
+
+    def index_table(self, entity, table, stats):
+        """
+        Record the column statistics gathered while loading a CSV file
+        entity's table, and index the columns selective enough to be worth
+        it.  This only happens after the load, so the inserts don't have to
+        keep the indexes up to date.
+        """
+        entity[u'row_count'] = stats['rows']
+        entity[u'column_nulls'] = stats['nulls']
+        entity[u'column_distinct'] = stats['distinct']
+        columns = loader.selective_columns(entity[u'columns'],
+                entity[u'column_types'], stats,
+                self.config.get('index_min_rows', 1000),
+                self.config.get('index_min_distinct', 20))
+        loader.create_indexes(DBSession, table, columns)
+        entity[u'indexed_columns'] = columns
+
+    def export_table(self, entity):
+        """
+        Return the path of a Parquet export of a CSV file entity's table,
+        writing it if the table changed since the last export.
+        """
+        exports = export.ExportCache(
+                self.config.get('export_dir') or
+                os.path.join(self.config['git_dir'], '.exports'),
+                self.config.get('export_batch_size', export.BATCH_SIZE))
+        return exports.get(entity, DBSession)
 
-                self.call_magic_handler(extracted, child)
-
-    def gzip_handler(self, entity):
-        """ Handles .gz files """
-        self.log.debug("gzip_handler(%s)" % entity)
-        entity[u'format'] = u'gz'
-        p = subprocess.Popen('gunzip "%s"' % entity[u'filename'],
-                             shell=True, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             cwd=dirname)
-        out, err = p.communicate()
-        if err:
-            self.log.error("Error unzipping: " + err)
+    def scrape_files_from_url(self, url, soup_links=False):
+        """
+        Crawl `url` up to `crawl_depth` links deep, yielding each link to a
+        file with one of our `extensions`, along with its soup tag if
+        `soup_links` is set.
+        """
+        crawler = Crawler(self, extensions.split(','),
+                          max_depth=self.config.get('crawl_depth', 2),
+                          workers=self.config.get('crawl_workers', 4),
+                          delay=self.config.get('crawl_delay', 1.0))
+        for link, soup_link in crawler.crawl(url):
+            if soup_links:
+                yield link, soup_link
+            else:
+                yield link
+
+    # File type handlers
+    def archive_handler(self, entity):
+        """ Handles zip (including self-extracting), tar and compressed files """
+        self.log.debug("archive_handler(%s)" % entity)
+        filename = entity[u'filename']
+        dirname = os.path.dirname(filename)
+        try:
+            entity[u'format'] = unicode(archive.get_format(filename))
+            self.metrics.count('extract', bytes=os.path.getsize(filename))
+            with self.metrics.timer('extract'):
+                extracted = archive.extract(filename, dirname,
+                        workers=self.config.get('extract_workers', 4))
+            self.metrics.count('extract', files=len(extracted))
+        except Exception, e:
+            self.log.error("Error extracting %s" % filename)
+            self.log.exception(e)
             return
 
-        magic = utils.get_magic(extracted)
-        self.call_magic_handler(extracted, child)
-
-    def tar_handler(self, entity):
-        """ Handles .tar files """
-        self.log.debug("tar_handler(%s)" % entity)
-        dirname = os.path.dirname(entity[u'filename'])
-        p = subprocess.Popen('tar -xvf "%s"' % entity[u'filename'],
-                             shell=True, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             cwd=dirname)
-        out, err = p.communicate()
-        if err:
-            self.log.error("Error unzipping: " + err)
-        else:
-            # Delete compressed data after extracting
-            os.unlink(entity[u'filename'])
+        # Delete compressed data after extracting
+        os.unlink(filename)
 
-        for line in out.split('\n'):
-            if line.strip().startswith('inflating'):
-                extracted = os.path.join(dirname, line.strip().split()[-1])
-                self.log.debug("extracted " + extracted)
-                magic = utils.get_magic(extracted)
+        for path in extracted:
+            self.log.debug("extracted " + path)
+            if isinstance(path, str):
+                path = path.decode('utf-8', 'replace')
 
-                # Create a new child Entity for each extracted file
-                child = Entity.by_name(extracted)
+            with self.uow.savepoint(path):
+                # Create a new child Entity for each extracted file, named by
+                # its path in the archive, as members in different
+                # directories can share a basename
+                name = os.path.relpath(path, dirname)
+                child = entity.children.get(name)
                 if not child:
-                    child = Entity(name=os.path.basename(extracted))
-                    child[u'filename'] = extracted
+                    child = Entity(name=name)
+                    child[u'filename'] = path
                     DBSession.add(child)
                     child.parent = entity
-                    child[u'magic'] = to_unicode(magic)
                     self.log.debug("Created %s" % child)
-                else:
-                    child.parent = entity
-
-                DBSession.flush()
 
-                self.call_magic_handler(extracted, child)
+                child[u'magic'] = self.call_magic_handler(path, child)
+                self.uow.added()
 
     def ascii_text_handler(self, entity):
         self.log.debug("ascii_text_handler(%s)" % entity)
         link = utils.get_fact_from_parents(u'link', entity)
         repo = utils.get_fact_from_parents(u'repo', entity)
-        #~ self.git_add_and_commit(entity.name, repo=repo)
         self.polymorphic_csv_populator(entity)
 
-    def polymorphic_csv_populator(self, entity):
+    def sniff_csv(self, entity):
         """
-        Reads the CSV into Knowledge.
-        TODO: no dynamic dialects?
+        Return the (dialect, encoding) of a CSV file entity.  Files are only
+        sniffed once per repo, unless one doesn't fit the dialect we already
+        found for it.
         """
-        try:
-            #flush_after = asint(config.get('transaction_size', 1000))
-            repo = utils.get_fact_from_parents(u'repo', entity)
-            custom_dialect = self.dialects.get(repo, None)
-            if not custom_dialect:
-                # Nothing to see hre, carry on.
-                pass
-            elif custom_dialect not in csv.list_dialects():
-                self.log.error("Dialect '%s' not found!" % custom_dialect)
-            csv_reader = csv.reader(entity['filename'], dialect=custom_dialect)
-
-            columns = None
-            # TODO: See if this file has already been parsed!
-
-            for i, line in enumerate(csv_reader):
-                if i == 0:
-                    columns = line
-
-                    # then create a Table object with the appropriate columns
-                    table_name = u'civx_' + unicode(uuid.uuid4()).replace('-', '')
-                    entity[u'table_name'] = table_name
-                    entity[u'column_names'] = columns
-                    # The actual column names behind the scenes.  CIVX will
-                    # map them to the 'column_names'
-                    entity[u'columns'] = [u'col_%d' % i for i in
-                                          range(len(columns))]
-                    #DBSession.flush()
-                    table, model = utils.get_mapped_table_model_from_entity(entity)
-                    model.__table__ = table
-
-                    civx.model.models[model] = {
-                            'csv': [entity[u'filename']],
-                            'columns': entity[u'columns'],
-                            'tmp_csv': {}
-                            }
-
-                    metadata.create_all()
-                    continue
-                break
-
-            self.log.info("%d entries in %r table" % (
-                    DBSession.query(model).count(),
-                    entity[u'table_name']))
-
-            populate_csv((
-                    utils.get_fact_from_parents('repo', entity),
-                    entity[u'filename'],
-                    model,
-                    self.engine), dialect=custom_dialect)
+        repo = utils.get_fact_from_parents(u'repo', entity)
+        filename = entity[u'filename']
+        if repo in self.sniffed:
+            dialect, encoding = self.sniffed[repo]
+            if reader.fits(filename, dialect):
+                return dialect, encoding
+
+        dialect, encoding = reader.sniff(filename)
+        custom_dialect = self.dialects.get(repo, None)
+        if not custom_dialect:
+            # Nothing to see hre, carry on.
+            pass
+        elif custom_dialect not in csv.list_dialects():
+            self.log.error("Dialect '%s' not found!" % custom_dialect)
+        else:
+            dialect = csv.get_dialect(custom_dialect)
+        self.sniffed[repo] = (dialect, encoding)
+        return dialect, encoding
 
-            self.log.info("%d entries in %r table" % (
-                    DBSession.query(model).count(),
-                    entity[u'table_name']))
+    def update_csv_table(self, entity, rows, dialect, encoding):
+        """
+        Bring the existing table of a CSV file entity up to date with the
+        file, and return its model.
 
-            DBSession.commit()
+        If the file only had lines appended to it since the last load, just
+        those lines are loaded.  Otherwise the rows are diffed against the
+        table, and only the changed rows are inserted or deleted.
+        """
+        filename = entity[u'filename']
+        transaction_size = self.config.get('transaction_size', 1000)
+        table, model = utils.get_mapped_table_model_from_entity(entity)
+        # Tables from before we inferred types are all text
+        types = u'column_types' in entity.facts and entity[u'column_types']
+
+        if (u'loaded_bytes' in entity.facts and utils.is_appended(
+                filename, entity[u'loaded_bytes'], entity[u'loaded_digest'])):
+            self.log.info("Loading lines appended to %s" % filename)
+            rows.close()
+            rows = reader.iter_rows(filename, dialect, encoding,
+                                    offset=entity[u'loaded_bytes'])
+            with self.metrics.timer('load'):
+                inserted = loader.bulk_load(DBSession, table,
+                        entity[u'columns'],
+                        reader.iter_batches(rows, transaction_size), types)
+        else:
+            self.log.info("Loading changed rows of %s" % filename)
+            with self.metrics.timer('load'):
+                inserted, deleted = loader.sync_rows(DBSession, table,
+                        entity[u'columns'], rows, transaction_size, types)
+            self.metrics.count('load', deleted=deleted)
+        self.metrics.count('load', rows=inserted)
+        return model
+
+    def infer_column_types(self, entity, dialect, encoding, width):
+        """
+        Infer the type of each column of a CSV file entity from its first
+        `type_sample_rows` rows, or from all of them if that isn't set.
+        Values that turn out not to fit are loaded into the graveyard.
+        """
+        rows = reader.iter_rows(entity[u'filename'], dialect, encoding)
+        rows.next()
+        sample = self.config.get('type_sample_rows')
+        if sample:
+            rows = itertools.islice(rows, sample)
+        types = reader.infer_types(rows, width)
+        self.log.debug("Column types of %s: %s" % (entity[u'filename'],
+                                                   u', '.join(types)))
+        return types
 
-        except Exception, e:
-            self.log.error('Unable to parse file as CSV')
-            self.log.exception(e)
+    def polymorphic_csv_populator(self, entity):
+        """
+        Reads the CSV into Knowledge.
+        """
+        try:
+            with self.metrics.timer('csv'):
+                dialect, encoding = self.sniff_csv(entity)
+                rows = reader.iter_rows(entity[u'filename'], dialect, encoding)
+
+                # The first line holds the column names
+                columns = rows.next()
+            self.metrics.count('csv', bytes=os.path.getsize(entity[u'filename']))
+
+            if (u'table_name' in entity.facts and
+                entity[u'column_names'] == columns):
+                # This file has already been parsed
+                model = self.update_csv_table(entity, rows, dialect, encoding)
+                self.mark_loaded(entity)
+            else:
+                # then create a Table object with the appropriate columns
+                table_name = u'civx_' + unicode(uuid.uuid4()).replace('-', '')
+                entity[u'table_name'] = table_name
+                entity[u'column_names'] = columns
+                # The actual column names behind the scenes.  CIVX will
+                # map them to the 'column_names'
+                entity[u'columns'] = [u'col_%d' % i for i in
+                                      range(len(columns))]
+                with self.metrics.timer('csv'):
+                    entity[u'column_types'] = self.infer_column_types(entity,
+                            dialect, encoding, len(columns))
+                table, model = utils.get_mapped_table_model_from_entity(entity)
+                model.__table__ = table
+
+                # Big files are split up to be loaded by several workers
+                ranges = self.split_csv(entity, dialect)
+                pool = self.load_pool
+                if ranges and not pool:
+                    pool = self.process_pool(min(len(ranges),
+                            self.config.get('ingest_processes', 1)))
+
+                if pool:
+                    # Worker processes load it on their own connections, so
+                    # the table is created in a transaction of its own for
+                    # them to see, rather than committing ours
+                    with DBSession.get_bind().begin() as connection:
+                        table.create(bind=connection, checkfirst=True)
+                    rows.close()
+                    results = [pool.apply_async(loader.load_csv, (
+                            loader.engine_url(DBSession.get_bind()),
+                            table_name, entity[u'columns'],
+                            entity[u'filename'], reader.dialect_params(dialect),
+                            encoding, self.config.get('transaction_size', 1000),
+                            entity[u'column_types'], start, end))
+                        for start, end in ranges or [(0, None)]]
+                    if pool is self.load_pool:
+                        self.pending_loads.append((entity, results))
+                    else:
+                        try:
+                            with self.metrics.timer('load'):
+                                self.wait_loads(entity, results)
+                        finally:
+                            pool.terminate()
+                else:
+                    table.create(bind=DBSession.connection(), checkfirst=True)
+                    batches = reader.iter_batches(rows,
+                            self.config.get('transaction_size', 1000))
+                    stats = loader.ColumnStats(len(columns),
+                            types=entity[u'column_types'])
+                    with self.metrics.timer('load'):
+                        count = loader.bulk_load(DBSession, table,
+                                entity[u'columns'], batches,
+                                entity[u'column_types'], stats)
+                        self.index_table(entity, table, stats.summary())
+                    self.metrics.count('load', rows=count)
+                    self.mark_loaded(entity)
+
+            if not self.load_pool:
+                self.log.info("%d entries in %r table" % (
+                        DBSession.query(model).count(),
+                        entity[u'table_name']))
+
+        except Exception:
+            # Let the savepoint around this file roll back its work
+            self.log.error('Unable to parse %s as CSV' % entity[u'filename'])
+            raise
 
     # Hostname specific handlers
     def data_gov_handler(self, url):
@@ -534,11 +856,11 @@ class PolyScraper(Scraper):
                   'Additional Metadata')
 
         # Our top-level data.gov entity
-        data_gov = Entity.by_name('data.gov')
+        data_gov = self.entities.get(u'data.gov')
         if not data_gov:
             data_gov = Entity(name=u'data.gov')
             DBSession.add(data_gov)
-            root = Entity.by_name(u'CIVX')
+            root = self.entities.get(u'CIVX')
             if not root:
                 root = Entity(name=u'CIVX')
                 DBSession.add(root)
@@ -562,13 +884,17 @@ class PolyScraper(Scraper):
             DBSession.add(entity)
             dest = [self.config['git_dir'], hostname]
 
-            # Extract data for each field
-            for field in fields:
-                data = soup.find(text=field)
-                if data and data.next and data.next.next:
+            # Extract data for each field, in a single pass over the page
+            seen = set()
+            for data in soup.find_all(text=fields):
+                field = unicode(data)
+                if field in seen:
+                    continue
+                seen.add(field)
+                if data.next and data.next.next:
                     data = data.next.next.string
                     if data:
-                        entity[unicode(field)] = data.decode('utf-8').strip()
+                        entity[field] = data.decode('utf-8').strip()
 
             DBSession.flush()
 
@@ -602,29 +928,33 @@ class PolyScraper(Scraper):
                 data = button.string.split()[0]
                 link = button['href']
                 if link:
-                    link = urljoin('http://explore.data.gov', link)
+                    # lxml hands back ascii attribute values as str
+                    link = urljoin(u'http://explore.data.gov', link)
                     entity[data.lower()] = link
                     parsed_link = urlparse(link)
                     file_name = parsed_link[2].split('/')[-1]
 
-                    raw = self.download_file(link)
-                    filename = os.path.join(dest, file_name)
-                    shutil.move(raw, filename)
-                    self.log.debug("Moved %s to %s" % (raw, filename))
+                    filename = self.download_file(link,
+                            os.path.join(dest, file_name))
 
-                    # Create a new entity for this file
-                    file_entity = Entity(name=link)
-                    DBSession.add(file_entity)
-                    file_entity[u'filename'] = filename
-                    file_entity.parent = entity
+                    with self.uow.savepoint(link):
+                        # Create a new entity for this file
+                        file_entity = Entity(name=link)
+                        DBSession.add(file_entity)
+                        file_entity[u'filename'] = filename
+                        file_entity.parent = entity
 
-                    # Process this file accordingly
-                    self.call_magic_handler(filename, file_entity)
+                        # Process this file accordingly
+                        if not self.dedup_file(filename, file_entity):
+                            self.call_magic_handler(filename, file_entity)
+                        self.uow.added()
 
             # Find external map links
             map = soup.find('a', href=re.compile(r'^/externallink/map/'))
             if map:
                 map = urllib.unquote(map.get('href', '')[18:]).split('/')[0].replace('###', '/')
+                if isinstance(map, str):
+                    map = map.decode('utf-8', 'replace')
                 entity[u'map'] = map
 
             DBSession.flush()
@@ -660,7 +990,7 @@ class PolyScraper(Scraper):
 
         login()
         b.follow_link(b.find_link('Bulk Data'))
-        soup = BeautifulSoup(b.get_html())
+        soup = BeautifulSoup(b.get_html(), PARSER)
 
         links = {}
 
@@ -701,18 +1031,18 @@ class PolyScraper(Scraper):
         parsed_url = urlparse(url)
         hostname = parsed_url[1].replace('www.', '')
 
-        parent = Entity.by_name(hostname)
+        parent = self.entities.get(hostname)
         if not parent:
             parent = Entity(name=hostname)
             DBSession.add(parent)
-            root = Entity.by_name(u'CIVX')
+            root = self.entities.get(u'CIVX')
             if not root:
                 root = Entity(name=u'CIVX')
                 DBSession.add(root)
             parent.parent = root
 
         # See if this entity already exists
-        entity = Entity.by_name(url)
+        entity = self.entities.get(url)
         if entity:
             self.log.info('Entity(%r) already exists; skipping.' % url)
             return
@@ -732,7 +1062,7 @@ class PolyScraper(Scraper):
                 dest.append(entity.name)
 
                 DBSession.add(entity)
-                DBSession.flush()
+                self.uow.added()
 
             dest = os.path.join(*dest)
             if not os.path.isdir(dest):
@@ -749,39 +1079,68 @@ class PolyScraper(Scraper):
                 else:
                     filename = link['href'].split('/')[-1]
                 filename = os.path.join(dest, filename)
-                save_html(filename)
+                # Replace, rather than overwrite, what may be a stored blob
+                save_html(filename + '.part')
+                os.rename(filename + '.part', filename)
 
-                file_entity = Entity(name=link.contents[0])
-                file_entity[u'filename'] = filename
-                file_entity[u'repo'] = hostname
-                DBSession.add(file_entity)
-                file_entity.parent = entity
-                self.log.debug("Created entity %r (parent %r)" % (
-                    file_entity.name, file_entity.parent.name))
+                with self.uow.savepoint(filename):
+                    file_entity = Entity(name=link.contents[0])
+                    file_entity[u'filename'] = filename
+                    file_entity[u'repo'] = hostname
+                    DBSession.add(file_entity)
+                    file_entity.parent = entity
+                    self.log.debug("Created entity %r (parent %r)" % (
+                        file_entity.name, file_entity.parent.name))
 
-                magic = self.call_magic_handler(filename, file_entity)
-                file_entity[u'magic'] = magic
+                    magic = self.call_magic_handler(filename, file_entity)
+                    file_entity[u'magic'] = magic
+                    self.uow.added()
 
-                DBSession.flush()
+        self.uow.flush()
 
-    def call_magic_handler(self, filename, entity):
-        """ Determine the file magic, and call the appropriate handler """
-        magic = utils.get_magic(filename)
-        if magic in self.magic_types:
-            self.log.info('Calling %r for %s magic' % (
-                self.magic_types[magic], magic))
-            self.magic_types[magic](self, entity)
+    def get_magic_handler(self, magic):
+        """
+        Return the handler for a magic string, or None.  Exact matches win,
+        then all of the regex magic patterns are tried in a single pass.
+        """
+        if self._magic_handlers is None:
+            self._magic_handlers = {}
+            patterns = [(u'magic%d' % i, pattern) for i, pattern in
+                        enumerate(self.magic_types)
+                        if isinstance(pattern, type(re.compile(r'foo')))]
+            self._magic_patterns = dict(patterns)
+            self._magic_regex = re.compile(u'|'.join(
+                u'(?P<%s>%s)' % (name, pattern.pattern)
+                for name, pattern in patterns))
+
+        if magic not in self._magic_handlers:
+            handler = self.magic_types.get(magic)
+            if handler is None and self._magic_patterns:
+                match = self._magic_regex.match(magic)
+                if match:
+                    for name, value in match.groupdict().items():
+                        if value is not None and name in self._magic_patterns:
+                            handler = self.magic_types[
+                                self._magic_patterns[name]]
+                            break
+            self._magic_handlers[magic] = handler
+        return self._magic_handlers[magic]
+
+    def call_magic_handler(self, filename, entity, magic=None):
+        """
+        Determine the file magic, unless we already know it, and call the
+        appropriate handler
+        """
+        self.git_add(filename)
+        if magic is None:
+            with self.metrics.timer('magic'):
+                magic = utils.get_magic(filename)
+        handler = self.get_magic_handler(magic)
+        if handler:
+            self.log.info('Calling %r for %s magic' % (handler, magic))
+            handler(self, entity)
         else:
-            # Try to match any regex magic patterns
-            for pattern in self.magic_types:
-                if isinstance(pattern, type(re.compile(r'foo'))):
-                    if re.match(pattern, magic):
-                        self.log.info('Calling %r for %s magic' % (
-                            self.magic_types[pattern], magic))
-                        self.magic_types[pattern](self, entity)
-                        break
-            else:
-                self.log.error('No handler for magic: %s' % magic)
+            self.log.error('No handler for magic: %s' % magic)
         return magic
 
     ##
@@ -789,11 +1148,15 @@ class PolyScraper(Scraper):
     ## that specific data type.
     ##
     magic_types = {
-        re.compile(r'PE32 executable.*for MS Windows.*'): zip_exe_handler,
-        re.compile(r'Zip.*'): zip_exe_handler,
+        re.compile(r'PE32 executable.*for MS Windows.*'): archive_handler,
+        re.compile(r'Zip.*'): archive_handler,
         re.compile(r'.*ASCII.*'): ascii_text_handler,
         re.compile(r'UTF-8.*'): ascii_text_handler,
-        re.compile(r'gzip compressed data.*'): gzip_handler,
+        re.compile(r'CSV text.*'): ascii_text_handler,
+        re.compile(r'gzip compressed data.*'): archive_handler,
+        re.compile(r'bzip2 compressed data.*'): archive_handler,
+        re.compile(r'XZ compressed data.*'): archive_handler,
+        re.compile(r'POSIX tar archive.*'): archive_handler,
     }
 
     url_handlers = {
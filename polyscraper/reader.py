@@ -0,0 +1,276 @@
+"""
+Streaming CSV ingestion.
+
+Files are read through a buffered binary handle and handed out a row, or a
+batch of rows, at a time, so memory use doesn't depend on the file size.
+"""
+
+import os
+import re
+import csv
+import mmap
+import codecs
+
+from datetime import datetime
+
+# Enough to see a couple hundred lines of most datasets
+SAMPLE_SIZE = 64 * 1024
+BUFFER_SIZE = 1024 * 1024
+# Bytes of a mapped file to count quotes in at a time
+SCAN_SIZE = 64 * 1024 * 1024
+
+# Column types, and what a value has to look like to be one
+INTEGER_RE = re.compile(r'^[-+]?(0|[1-9][0-9]*)$')
+FLOAT_RE = re.compile(r'^[-+]?((0|[1-9][0-9]*)(\.[0-9]*)?|\.[0-9]+)'
+                      r'([eE][-+]?[0-9]+)?$')
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y')
+BOOLEANS = {u'true': True, u't': True, u'yes': True,
+            u'false': False, u'f': False, u'no': False}
+STRING_LENGTH = 255
+
+def sniff(filename, sample_size=SAMPLE_SIZE):
+    """
+    Guess the dialect and encoding of a CSV file from its first
+    `sample_size` bytes.  Returns a (dialect, encoding) tuple.
+    """
+    with open(filename, 'rb') as csv_file:
+        sample = csv_file.read(sample_size)
+
+    encoding = 'utf-8'
+    if sample.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+    else:
+        try:
+            sample.decode('utf-8')
+        except UnicodeDecodeError, e:
+            # A multibyte character cut off by the end of the sample is fine
+            if e.start < len(sample) - 3:
+                encoding = 'windows-1252'
+
+    # Only hand whole lines to the sniffer
+    if len(sample) == sample_size and '\n' in sample:
+        sample = sample[:sample.rindex('\n')]
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',\t|;')
+    except csv.Error:
+        dialect = csv.excel
+    return dialect, encoding
+
+def dialect_params(dialect):
+    """ Return the format parameters of a dialect, which can be pickled """
+    return dict((name, getattr(dialect, name)) for name in (
+        'delimiter', 'doublequote', 'escapechar', 'lineterminator',
+        'quotechar', 'quoting', 'skipinitialspace'))
+
+def make_dialect(params):
+    """ Build a dialect from the parameters returned by dialect_params """
+    return type('SniffedDialect', (csv.Dialect, object), params)
+
+def fits(filename, dialect):
+    """ Return whether the header of a file looks like it uses `dialect` """
+    with open(filename, 'rb') as csv_file:
+        header = csv_file.readline()
+    return dialect.delimiter in header
+
+def iter_rows(filename, dialect, encoding, offset=0, end=None):
+    """
+    Yield each row of a CSV file as a list of unicode values, starting at
+    byte `offset` and stopping at byte `end`, which must both be the start
+    of a record.
+    """
+    with open(filename, 'rb', BUFFER_SIZE) as csv_file:
+        if encoding == 'utf-8-sig':
+            offset = offset or len(codecs.BOM_UTF8)
+            encoding = 'utf-8'
+        csv_file.seek(offset)
+        lines = csv_file
+        if end is not None:
+            lines = _lines_until(csv_file, end - offset)
+        for row in csv.reader(lines, dialect=dialect):
+            yield [value.decode(encoding, 'replace') for value in row]
+
+def _lines_until(csv_file, size):
+    """ Yield the lines in the next `size` bytes of a file """
+    if size <= 0:
+        return
+    for line in csv_file:
+        yield line
+        size -= len(line)
+        if size <= 0:
+            return
+
+
+class BoundaryScanner(object):
+    """
+    Finds where the records of a memory mapped CSV file end.  A newline
+    only ends a record if it's outside of quotes, which it is when an even
+    number of quote characters come before it; escaped quotes are doubled,
+    so they don't change that.  Both searches run over the mapped bytes in
+    C, a chunk at a time, rather than a line at a time in Python.
+
+    Positions must be asked about in increasing order.
+    """
+
+    def __init__(self, data, quotechar='"'):
+        self.data = data
+        self.quotechar = quotechar
+        self.pos = 0
+        self.quotes = 0
+
+    def _count_quotes(self, end):
+        while self.pos < end:
+            chunk_end = min(end, self.pos + SCAN_SIZE)
+            self.quotes += self.data[self.pos:chunk_end].count(self.quotechar)
+            self.pos = chunk_end
+
+    def record_end(self, pos):
+        """
+        Return the offset just past the first record boundary at or after
+        `pos`, or the size of the file if there isn't one.
+        """
+        pos = max(pos, self.pos)
+        while True:
+            newline = self.data.find('\n', pos)
+            if newline == -1:
+                return len(self.data)
+            if not self.quotechar:
+                return newline + 1
+            self._count_quotes(newline)
+            if not self.quotes % 2:
+                return newline + 1
+            pos = newline + 1
+
+def split_ranges(filename, dialect, parts):
+    """
+    Split the rows of a CSV file, after its header, into about `parts`
+    (start, end) byte ranges that begin and end on record boundaries, so
+    each can be read on its own with iter_rows.
+
+    A quote character that isn't at the start of a field would throw off
+    which newlines are quoted, as would an escape character; files using
+    an escapechar dialect get a single range.
+    """
+    size = os.path.getsize(filename)
+    if not size:
+        return []
+    with open(filename, 'rb') as csv_file:
+        data = mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        quotechar = dialect.quoting != csv.QUOTE_NONE and dialect.quotechar
+        scanner = BoundaryScanner(data, quotechar or None)
+        start = scanner.record_end(0)
+        if dialect.escapechar:
+            parts = 1
+        step = max((size - start) // max(parts, 1), 1)
+        ranges = []
+        while start < size:
+            end = scanner.record_end(start + step - 1)
+            ranges.append((start, end))
+            start = end
+        return ranges
+    finally:
+        data.close()
+
+def _integer(value, limit=2 ** 31):
+    # Leading zeros mean an identifier, like a ZIP code, not a number
+    if not INTEGER_RE.match(value):
+        raise ValueError(value)
+    number = int(value)
+    if not -limit <= number < limit:
+        raise ValueError(value)
+    return number
+
+def _bigint(value):
+    return _integer(value, 2 ** 63)
+
+def _float(value):
+    if not FLOAT_RE.match(value):
+        raise ValueError(value)
+    return float(value)
+
+def _date(value):
+    for format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, format).date()
+        except ValueError:
+            pass
+    raise ValueError(value)
+
+def _boolean(value):
+    try:
+        return BOOLEANS[value.lower()]
+    except KeyError:
+        raise ValueError(value)
+
+def _string(value):
+    if len(value) > STRING_LENGTH:
+        raise ValueError(value)
+    return value
+
+CONVERTERS = {
+    u'boolean': _boolean,
+    u'integer': _integer,
+    u'bigint': _bigint,
+    u'float': _float,
+    u'date': _date,
+    u'string': _string,
+    u'text': None,
+}
+
+# What a column becomes when a value doesn't fit its type, in order
+WIDENINGS = {
+    None: (u'boolean', u'integer', u'bigint', u'float', u'date', u'string',
+           u'text'),
+    u'boolean': (u'string', u'text'),
+    u'integer': (u'bigint', u'float', u'string', u'text'),
+    u'bigint': (u'float', u'string', u'text'),
+    u'float': (u'string', u'text'),
+    u'date': (u'string', u'text'),
+    u'string': (u'text',),
+}
+
+def infer_types(rows, width):
+    """
+    Return the most specific type that fits every non-empty value in each of
+    the first `width` columns of `rows`: boolean, integer, bigint, float,
+    date, string (up to STRING_LENGTH characters) or text.
+    """
+    types = [None] * width
+    for row in rows:
+        for i, value in enumerate(row[:width]):
+            kind = types[i]
+            if not value or kind == u'text':
+                continue
+            if kind is not None:
+                try:
+                    CONVERTERS[kind](value)
+                    continue
+                except ValueError:
+                    pass
+            for kind in WIDENINGS[kind]:
+                convert = CONVERTERS[kind]
+                try:
+                    convert and convert(value)
+                    break
+                except ValueError:
+                    pass
+            types[i] = kind
+    return [kind or u'text' for kind in types]
+
+def converters(types):
+    """
+    Return a function for each column type that turns a value into that
+    type, raising ValueError if it can't, or None for text columns.
+    """
+    return [CONVERTERS[kind] for kind in types]
+
+def iter_batches(rows, batch_size):
+    """ Group an iterable of rows into tuples of at most `batch_size` rows """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield tuple(batch)
+            batch = []
+    if batch:
+        yield tuple(batch)
@@ -0,0 +1,109 @@
+"""
+Versioned storage of scraped data, in one git repository per host.
+
+Files are staged as they are scraped, and committed all at once through a
+single `git fast-import` stream at the end of the scrape, so a scrape costs
+a handful of git processes no matter how many files it touched.
+"""
+
+import os
+import time
+import shutil
+import logging
+import subprocess
+
+log = logging.getLogger('PolyScraper')
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def quote_path(path):
+    """ Quote a path for fast-import, if it needs it """
+    if '\n' in path or path.startswith('"'):
+        return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"') \
+                            .replace('\n', '\\n')
+    return path
+
+
+class GitRepo(object):
+    """ A git repository holding the files scraped from one host """
+
+    committer = 'CIVX PolyScraper <scraper@civx.us>'
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.pending = set()
+
+    def git(self, *args, **kw):
+        """ Run a git command in this repository and return its output """
+        process = subprocess.Popen(('git',) + args, cwd=self.path,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        if process.returncode and kw.get('check', True):
+            raise subprocess.CalledProcessError(process.returncode,
+                                                'git ' + ' '.join(args), err)
+        return process.returncode == 0 and out.strip() or None
+
+    def init(self):
+        """ Create the repository, if it doesn't exist yet """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if not os.path.isdir(os.path.join(self.path, '.git')):
+            self.git('init', '-q')
+        self.branch = self.git('symbolic-ref', 'HEAD')
+
+    def head(self):
+        """ Return the id of the latest commit, or None """
+        return self.git('rev-parse', '--verify', '-q', self.branch + '^0',
+                        check=False)
+
+    def add(self, filename):
+        """ Stage a file, or the removal of a file, for the next commit """
+        filename = os.path.abspath(filename)
+        if not filename.startswith(self.path + os.sep):
+            log.debug("%s is outside of %s" % (filename, self.path))
+            return
+        self.pending.add(os.path.relpath(filename, self.path))
+
+    def commit(self, message):
+        """
+        Commit everything staged since the last commit, and return the new
+        commit id.  Returns None if nothing was staged.
+        """
+        if not self.pending:
+            return None
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        parent = self.head()
+
+        process = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                                   cwd=self.path, stdin=subprocess.PIPE)
+        stream = process.stdin
+        stream.write('commit %s\n' % self.branch)
+        stream.write('committer %s %d +0000\n' % (self.committer,
+                                                  int(time.time())))
+        stream.write('data %d\n%s\n' % (len(message), message))
+        if parent:
+            stream.write('from %s\n' % parent)
+        for path in sorted(self.pending):
+            filename = os.path.join(self.path, path)
+            if isinstance(path, unicode):
+                path = path.encode('utf-8')
+            if not os.path.isfile(filename):
+                stream.write('D %s\n' % quote_path(path))
+                continue
+            stream.write('M 100644 inline %s\n' % quote_path(path))
+            stream.write('data %d\n' % os.path.getsize(filename))
+            with open(filename, 'rb') as data:
+                shutil.copyfileobj(data, stream, CHUNK_SIZE)
+            stream.write('\n')
+        stream.close()
+        if process.wait():
+            raise subprocess.CalledProcessError(process.returncode,
+                                                'git fast-import')
+        self.pending.clear()
+
+        # Bring the index up to date with what we just committed
+        self.git('read-tree', self.branch)
+        return self.head()
@@ -1,29 +1,352 @@
-import urllib
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+import requests
+
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
 
 from bs4 import BeautifulSoup
 
+from polyscraper import local, utils
+from polyscraper.cache import PageCache
+from polyscraper.metrics import Metrics
+from polyscraper.repo import GitRepo
+
+try:
+    import lxml
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+def get_validators(response):
+    """ Return the etag and last_modified validators of a response """
+    validators = {}
+    if response.headers.get('etag'):
+        validators[u'etag'] = unicode(response.headers['etag'])
+    if response.headers.get('last-modified'):
+        validators[u'last_modified'] = unicode(
+                response.headers['last-modified'])
+    return validators
+
+
+class NotModified(Exception):
+    """ The server says our copy of a file is still current """
+
+
+class NotHTML(Exception):
+    """ A page we only wanted to parse turned out to be something else """
+
+HTML_TYPES = ('', 'text/html', 'application/xhtml+xml')
+
+def is_html(response):
+    """ Return whether a response is HTML, or doesn't say what it is """
+    content_type = response.headers.get('content-type', '')
+    return content_type.split(';')[0].strip().lower() in HTML_TYPES
+
+
 class Scraper(object):
     git_repo = None
+    config = {}
+    _local = threading.local()
+
+    # SoupStrainers for hosts whose handlers only need some of each page
+    parse_only = {}
+
+    # Shared by every scraper in this process
+    page_cache = PageCache()
+
+    # Timers and counters for each stage of a scrape
+    metrics = Metrics()
 
     def get_browser(self):
         """ Get a Twill browser """
         return get_browser()
 
+    def init_git_repo(self, repo):
+        """ Initialize the git repository for a data source """
+        self.git_repo = GitRepo(os.path.join(self.config['git_dir'], repo))
+        self.git_repo.init()
+
+    def get_repo_dir(self):
+        return self.git_repo.path
+
+    def git_add(self, filename):
+        """ Stage a file to be committed at the end of the scrape """
+        if self.git_repo:
+            self.git_repo.add(filename)
+
+    def git_commit(self, message):
+        """ Commit every file staged during this scrape as one commit """
+        if self.git_repo:
+            with self.metrics.timer('commit'):
+                return self.git_repo.commit(message)
+
+    def get_latest_commit_id(self):
+        if self.git_repo:
+            commit = self.git_repo.head()
+            return commit and unicode(commit)
+
     def get_engine(self):
         return engine
 
-    def get_soup(self, url):
-        """ Get a BeautifulSoup object for a given url """
-        return BeautifulSoup(urllib.urlopen(url).read())
+    def get_soup(self, url, parse_only=None, html_only=False):
+        """
+        Get a BeautifulSoup object for a given url.  Only the tags matched by
+        the `parse_only` SoupStrainer, or the one registered for the url's
+        host, are parsed.  Parsed trees are kept in the page cache.
 
-    def download_file(self, url):
+        With `html_only`, raise NotHTML instead of downloading and parsing
+        anything that isn't a web page.
+        """
+        if parse_only is None:
+            hostname = urlparse(url)[1].replace('www.', '')
+            parse_only = self.parse_only.get(hostname)
+        page = self.get_page(url, html_only)
+        key = parse_only and str(parse_only)
+        soup = page.trees.get(key)
+        if soup is None:
+            with self.metrics.timer('parse'):
+                soup = BeautifulSoup(page.body, PARSER, parse_only=parse_only)
+            self.metrics.count('parse', bytes=len(page.body))
+            if self.config.get('cache_trees', True):
+                self.page_cache.add_tree(page, key, soup)
+        return soup
+
+    def get_page(self, url, html_only=False):
+        """
+        Return the cached Page for a url, fetching it if we don't have it.
+        Pages older than `page_max_age` seconds are revalidated with a
+        conditional GET first.
+
+        With `html_only`, the response is dropped as soon as its headers
+        say it isn't HTML, and NotHTML is raised.
+        """
+        page = self.page_cache.get(url)
+        headers = {}
+        if page is not None:
+            if time.time() - page.checked < self.config.get('page_max_age', 300):
+                return page
+            if page.validators.get(u'etag'):
+                headers['If-None-Match'] = page.validators[u'etag']
+            if page.validators.get(u'last_modified'):
+                headers['If-Modified-Since'] = page.validators[u'last_modified']
+
+        with self.metrics.timer('fetch'):
+            response = self.get_session().get(url, headers=headers,
+                    stream=True,
+                    timeout=self.config.get('download_timeout', 60))
+            try:
+                if page is not None and response.status_code == 304:
+                    page.checked = time.time()
+                    return page
+                response.raise_for_status()
+                if html_only and not is_html(response):
+                    raise NotHTML(url)
+                content = response.content
+            finally:
+                response.close()
+        self.metrics.count('fetch', bytes=len(content))
+
+        return self.page_cache.put(url, content, get_validators(response))
+
+    def get_session(self):
+        """ Get this thread's pooled, keep-alive HTTP session """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def download_file(self, url, filename=None):
+        """
+        Stream `url` to `filename` and return the filename.  Without a
+        filename the data goes to the git repo, or to a temporary file.
+        """
+        return self.fetch_file(url, filename)[0]
+
+    def fetch_file(self, url, filename=None, validators=None):
+        """
+        Stream `url` to `filename` in `chunk_size` pieces and return a
+        (filename, validators) tuple, where validators holds the `etag`,
+        `last_modified` and `content_length` the server sent back, and the
+        `sha1` of the file.
+
+        Passing the validators from a previous fetch turns this into a
+        conditional GET, which raises NotModified if the file hasn't changed.
+
+        Data is written to `filename`.part and renamed into place once it is
+        complete, so an interrupted download is resumed with a Range request
+        on the next attempt instead of starting from zero.  The request is
+        made with If-Range, so if the file changed in the meantime the
+        server sends all of it again.  Only connection errors and server
+        errors are retried.
+        """
         self.log.info("Downloading %s" % url)
-        # If a git repo is specified, move the file there.
-        if self.git_repo:
-            repodir = self.get_repo_dir()
-            filename, status = urllib.urlretrieve(url,
-                    filename=os.path.join(repodir, url.split('/')[-1]))
+        if os.path.exists(url):
+            # A local file, just like urlretrieve.
+            if filename:
+                with local.replacing(filename) as out:
+                    with open(url, 'rb') as src:
+                        shutil.copyfileobj(src, out)
+                return filename, {}
+            return url, {}
+
+        if not filename:
+            # If a git repo is specified, move the file there.
+            if self.git_repo:
+                repodir = self.get_repo_dir()
+                filename = os.path.join(repodir, url.split('/')[-1])
+            else:
+                fd, filename = tempfile.mkstemp()
+                os.close(fd)
+
+        chunk_size = self.config.get('chunk_size', 64 * 1024)
+        retries = self.config.get('download_retries', 3)
+        partial = filename + '.part'
+        # The validators of the response the partial file came from, which
+        # for one left over from an earlier scrape are the ones we stored
+        validators = validators or {}
+        resume = dict(validators)
+        with self.metrics.timer('fetch'):
+            for attempt in range(retries + 1):
+                try:
+                    validators = self._stream(url, partial, chunk_size,
+                                              validators, resume)
+                    break
+                except requests.RequestException, e:
+                    response = getattr(e, 'response', None)
+                    if (attempt == retries or response is not None and
+                        response.status_code < 500):
+                        raise
+                    self.log.warning("Retrying %s after error: %s" % (url, e))
+                    time.sleep(2 ** attempt)
+
+        os.rename(partial, filename)
+        self.metrics.count('fetch', bytes=os.path.getsize(filename))
+        return filename, validators
+
+    def _stream(self, url, partial, chunk_size, validators, resume):
+        """
+        Append the remainder of `url` to the `partial` file, and return the
+        response's validators along with the SHA-1 of the whole file.
+
+        `resume` holds the validators of the response the partial file came
+        from, and is updated whenever the file is started over.  A partial
+        file without any can't be checked, so it is started over too.
+        """
+        offset = 0
+        headers = {}
+        if_range = (resume.get(u'etag') and
+                    not resume[u'etag'].startswith('W/') and resume[u'etag'] or
+                    resume.get(u'last_modified'))
+        if os.path.exists(partial) and not if_range:
+            os.unlink(partial)
+        if os.path.exists(partial):
+            offset = os.path.getsize(partial)
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = if_range
         else:
-            filename, status = urllib.urlretrieve(url)
+            if validators.get(u'etag'):
+                headers['If-None-Match'] = validators[u'etag']
+            if validators.get(u'last_modified'):
+                headers['If-Modified-Since'] = validators[u'last_modified']
+
+        response = self.get_session().get(url, headers=headers, stream=True,
+                timeout=self.config.get('download_timeout', 60))
+        try:
+            if response.status_code == 304:
+                raise NotModified(url)
+            if offset and response.status_code == 416:
+                # We already have the whole thing
+                return {u'content_length': offset,
+                        u'sha1': utils.file_digest(partial)}
+            response.raise_for_status()
+            if offset and response.status_code != 206:
+                self.log.debug("%s does not support resuming" % url)
+                offset = 0
+            elif offset:
+                self.log.debug("Resuming %s at %d bytes" % (url, offset))
+
+            total = response.headers.get('content-length')
+            total = total and int(total) + offset
+            validators = get_validators(response)
+            if not offset:
+                resume.clear()
+                resume.update(validators)
+            if total:
+                validators[u'content_length'] = total
+
+            # Hash the file as it comes in, including anything we resumed
+            digest = hashlib.sha1()
+            if offset:
+                with open(partial, 'rb') as f:
+                    for chunk in iter(lambda: f.read(chunk_size), ''):
+                        digest.update(chunk)
+
+            report_every = self.config.get('progress_bytes', 16 * 1024 * 1024)
+            received = offset
+            next_report = received + report_every
+            with open(partial, offset and 'ab' or 'wb') as out:
+                for chunk in response.iter_content(chunk_size):
+                    out.write(chunk)
+                    digest.update(chunk)
+                    received += len(chunk)
+                    if received >= next_report:
+                        next_report += report_every
+                        self.log.debug("%s: %d of %s bytes" % (
+                            url, received, total or 'unknown'))
+            validators[u'sha1'] = unicode(digest.hexdigest())
+            return validators
+        finally:
+            response.close()
+
+    def download_files(self, links):
+        """
+        Download a list of (link, filename, validators) tuples in parallel,
+        yielding (link, filename, validators) tuples in the same order as
+        `links`.
+
+        The downloads are spread over a pool of `download_workers` threads,
+        with at most `host_downloads` of them hitting any one host at a time.
+        The filename is None if the file was not modified, or if the download
+        failed.
+        """
+        workers = self.config.get('download_workers', 8)
+        per_host = self.config.get('host_downloads', 2)
+        host_locks = {}
+        lock = threading.Lock()
+
+        def fetch((link, filename, validators)):
+            host = urlparse(link)[1]
+            with lock:
+                if host not in host_locks:
+                    host_locks[host] = threading.BoundedSemaphore(per_host)
+            with host_locks[host]:
+                try:
+                    return (link,) + self.fetch_file(link, filename,
+                                                     validators)
+                except NotModified:
+                    self.log.info("%s has not been modified" % link)
+                except Exception, e:
+                    self.log.error("Unable to download %s" % link)
+                    self.log.exception(e)
+                return link, None, None
+
+        if workers <= 1 or len(links) <= 1:
+            for link in links:
+                yield fetch(link)
+            return
 
-        return filename
+        pool = ThreadPool(min(workers, len(links)))
+        try:
+            # imap hands results back in order, so the caller can create
+            # entities deterministically while later files are still
+            # downloading.
+            for result in pool.imap(fetch, links):
+                yield result
+        finally:
+            pool.terminate()
@@ -0,0 +1,68 @@
+"""
+Unit of work policy for the scraper's database session.
+"""
+
+import time
+import logging
+
+from contextlib import contextmanager
+
+log = logging.getLogger('PolyScraper')
+
+
+class UnitOfWork(object):
+    """
+    Flushes the session after every `flush_every` new entities, or once
+    `flush_interval` milliseconds have passed since the last flush, instead
+    of after every single one.  Both knobs are read from `config`.
+    """
+
+    def __init__(self, session, config):
+        self.session = session
+        self.config = config
+        self.pending = 0
+        self.last_flush = time.time()
+
+    def added(self, count=1):
+        """ Note that `count` entities were created or changed """
+        self.pending += count
+        interval = self.config.get('flush_interval', 1000) / 1000.0
+        if (self.pending >= self.config.get('flush_every', 100) or
+            time.time() - self.last_flush >= interval):
+            self.flush()
+
+    def flush(self):
+        self.session.flush()
+        self.pending = 0
+        self.last_flush = time.time()
+
+    @contextmanager
+    def savepoint(self, name):
+        """
+        Run a block of work inside a SAVEPOINT, so that if it fails only
+        that work is rolled back.  The error is logged rather than raised.
+        The work mustn't commit, as that would end the SAVEPOINT with it.
+
+        pysqlite mangles SAVEPOINTs, committing behind SQLAlchemy's back, so
+        on it the work so far is committed instead, and a failure rolls
+        back to there.
+        """
+        if self.session.get_bind().dialect.driver == 'pysqlite':
+            savepoint = None
+            self.session.commit()
+        else:
+            savepoint = self.session.begin_nested()
+        try:
+            yield
+            if savepoint is None:
+                self.session.commit()
+            elif savepoint.is_active:
+                savepoint.commit()
+        except Exception, e:
+            log.error("Rolling back %s" % name)
+            log.exception(e)
+            if savepoint is None:
+                self.session.rollback()
+            elif savepoint.is_active:
+                savepoint.rollback()
+            self.pending = 0
@@ -1,6 +1,17 @@
-from sqlalchemy import Boolean, Column, Integer, Table, UnicodeText
+import os
+import json
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from sqlalchemy import (BigInteger, Boolean, Column, Date, Float, Integer,
+                        Table, Unicode, UnicodeText, select)
+from sqlalchemy.orm import class_mapper, mapper
 import knowledge
 
+from polyscraper.reader import STRING_LENGTH
+
 def get_fact_from_parents(fact, entity):
     """
         Crawl through this entity's parents and return the first
@@ -11,54 +22,204 @@ def get_fact_from_parents(fact, entity):
             return entity.parent[fact]
         entity = entity.parent
 
+def file_digest(filename, size=None):
+    """ Return the SHA-1 hex digest of the first `size` bytes of a file """
+    digest = hashlib.sha1()
+    if size is None:
+        size = os.path.getsize(filename)
+    remaining = size
+    with open(filename, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return unicode(digest.hexdigest())
+
+def is_appended(filename, size, digest):
+    """
+    Return whether a file still starts with the `size` whole lines of data
+    whose digest was `digest`, meaning anything new was appended to it.
+    """
+    if os.path.getsize(filename) < size:
+        return False
+    with open(filename, 'rb') as f:
+        f.seek(size - 1)
+        if f.read(1) != '\n':
+            return False
+    return file_digest(filename, size) == digest
+
+# One libmagic handle per thread, and the magic of the files we've seen
+_local = threading.local()
+_magic_cache = {}
+MAGIC_CACHE_SIZE = 100000
+
+def get_magic_handle():
+    """ Return a function that finds the magic of a file, loading libmagic
+    only once per thread """
+    handle = getattr(_local, 'magic', None)
+    if handle is None:
+        import magic
+        if hasattr(magic, 'from_file'): # python-magic on PyPi
+            handle = magic.Magic().from_file
+        else:
+            m = magic.open(magic.MAGIC_NONE)
+            m.load()
+            handle = m.file
+        _local.magic = handle
+    return handle
+
 def get_magic(filename):
-    """ Return the magic type of a filename """
-    import magic
-    if hasattr(magic, 'from_file'): # python-magic on PyPi
-        return magic.from_file(filename)
-    else:
-        m = magic.open(magic.MAGIC_NONE)
-        m.load()
-        return m.file(filename)
+    """ Return the magic type of a filename, as unicode """
+    st = os.stat(filename)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    magic = _magic_cache.get(key)
+    if magic is None:
+        magic = get_magic_handle()(filename)
+        if isinstance(magic, str):
+            magic = magic.decode('utf-8', 'replace')
+        if len(_magic_cache) >= MAGIC_CACHE_SIZE:
+            _magic_cache.clear()
+        _magic_cache[key] = magic
+    return magic
+
+# The SQL type of each column type reader.infer_types can come up with
+COLUMN_TYPES = {
+    u'boolean': Boolean,
+    u'integer': Integer,
+    u'bigint': BigInteger,
+    u'float': Float,
+    u'date': Date,
+    u'string': Unicode(STRING_LENGTH),
+    u'text': UnicodeText,
+}
+
+# The tables we've mapped, and their models, most recently used last
+_models = OrderedDict()
+_models_lock = threading.Lock()
+MODEL_CACHE_SIZE = 1000
 
 def get_mapped_table_model_from_entity(entity):
-    model = get_polymorphic_model_object()
-    table = get_table_from_entity(entity)
-    mapper(model, table)
-    return table, model
+    """
+    Return the Table of an Entity, and a model class mapped to it.  Each
+    table is only mapped once; once more than MODEL_CACHE_SIZE are mapped,
+    the ones used least recently are disposed of.
+    """
+    table_name = entity[u'table_name']
+    with _models_lock:
+        mapped = _models.pop(table_name, None)
+        if mapped is None:
+            table = get_table_from_entity(entity)
+            model = get_polymorphic_model_object()
+            mapper(model, table)
+            model.describe(entity)
+            mapped = (table, model)
+        _models[table_name] = mapped
+        while len(_models) > MODEL_CACHE_SIZE:
+            dispose_model(*_models.popitem(last=False)[1])
+    return mapped
+
+def dispose_model(table, model):
+    """
+    Unmap a model, and drop its table from the metadata, so both can be
+    garbage collected.  get_table_from_entity will rebuild the table.
+    """
+    from knowledge.model import metadata
+    class_mapper(model).dispose()
+    if metadata.tables.get(table.key) is table:
+        metadata.remove(table)
 
 def get_polymorphic_model_object():
-    """ Return a model object class that can be mapped to a table """
+    """
+    Return a model object class that can be mapped to a table.  The name of
+    the entity that owns the table, and the names of its columns, are only
+    looked up once and are kept on the class.
+
+    Mapped objects can't have __slots__, so pages of rows are rendered or
+    serialized straight from the tuples SQLAlchemy Core hands back:
+
+        >>> rows = model.page(offset=0, limit=100)
+        >>> print model.render(rows)
+        >>> model.to_json(rows)
+    """
     class DynamicModelObject(object):
         __civx__ = {'skip_header': True, 'polymorphic': True}
+        # The owning entity's name, and its (column, column name) pairs
+        __civx_entity__ = None
+        __civx_columns__ = None
+
         def __init__(self, **kw):
             for key, value in kw.items():
                 setattr(self, key, value)
+
+        @classmethod
+        def describe(cls, entity):
+            """ Remember the names of the entity that owns our table """
+            cls.__civx_entity__ = entity.name
+            cls.__civx_columns__ = zip(entity[u'columns'],
+                                       entity[u'column_names'])
+
+        @classmethod
+        def columns(cls):
+            """ Return the (column, column name) pairs of our table """
+            if cls.__civx_columns__ is None:
+                from knowledge.model import Fact, DBSession
+                table_name = class_mapper(cls).mapped_table.name
+                # FIXME:
+                # (ProgrammingError) CASE types integer and text cannot be matched
+                # LINE 5: ...ger' THEN moksha_facts.int_value WHEN 'char' THEN
+                #entity = Knowledge.query(Entity).filter(Entity.facts.any(
+                #    with_characteristic(u'table_name', table_name))).one()
+                cls.describe(DBSession.query(Fact).filter_by(
+                        key=u'table_name', char_value=table_name).one().entity)
+            return cls.__civx_columns__
+
+        @classmethod
+        def page(cls, offset=0, limit=None):
+            """
+            Return rows of our table as tuples of values in column order,
+            without building an object for each of them.
+            """
+            from knowledge.model import DBSession
+            table = class_mapper(cls).mapped_table
+            query = select([table.c[col] for col, name in cls.columns()])
+            query = query.order_by(table.c.id).offset(offset).limit(limit)
+            return DBSession.connection().execute(query).fetchall()
+
+        @classmethod
+        def render_row(cls, values):
+            """ Render a tuple of values the way __repr__ renders a row """
+            names = [name for col, name in cls.columns()]
+            return cls.__civx_entity__ + ''.join(
+                    '\n * %s: %s' % pair for pair in zip(names, values))
+
+        @classmethod
+        def render(cls, rows):
+            return '\n'.join(cls.render_row(values) for values in rows)
+
+        @classmethod
+        def to_json(cls, rows):
+            """ Serialize rows as a JSON object of column names and rows """
+            return json.dumps({'columns': [name for col, name in cls.columns()],
+                               'rows': [list(values) for values in rows]},
+                              default=_json_default)
+
         def __repr__(self):
-            str = ''
-            from knowledge.model import Entity, with_characteristic, Fact, DBSession
-            table_name = self._sa_class_manager.mapper.mapped_table.name
-            # FIXME:
-            # (ProgrammingError) CASE types integer and text cannot be matched
-            # LINE 5: ...ger' THEN moksha_facts.int_value WHEN 'char' THEN
-            #entity = Knowledge.query(Entity).filter(Entity.facts.any(
-            #    with_characteristic(u'table_name', table_name))).one()
-
-            entity = DBSession.query(Fact).filter_by(key=u'table_name',
-                    char_value=table_name).one().entity
-            str += entity.name
-            for i, col in enumerate(entity[u'columns']):
-                str += '\n * %s: %s' % (entity[u'column_names'][i],
-                                        getattr(self, col))
-            return str
+            return self.render_row([getattr(self, col)
+                                    for col, name in self.columns()])
     return DynamicModelObject
 
+def _json_default(value):
+    """ Serialize the values json doesn't know about, like dates """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
 def get_table(table_name):
     """ Return a SQLAlchemy Table """
     from knowledge.model import metadata
-    for table in metadata.sorted_tables:
-        if table.name == table_name:
-            return table
+    return metadata.tables.get(table_name)
 
 def get_table_from_entity(entity):
     """ Return a SQLAlchemy Table built for a given Entity """
@@ -69,6 +230,8 @@ def get_table_from_entity(entity):
     cols = [Column('id', Integer, primary_key=True),
             Column('graveyard', UnicodeText),
             Column('flag', Boolean, default=False)]
-    for col in entity[u'columns']:
-        cols.append(Column(col, UnicodeText))
+    types = (u'column_types' in entity.facts and entity[u'column_types'] or
+             [u'text'] * len(entity[u'columns']))
+    for col, kind in zip(entity[u'columns'], types):
+        cols.append(Column(col, COLUMN_TYPES[kind]))
     return Table(entity[u'table_name'], metadata, *cols)
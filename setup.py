@@ -7,6 +7,7 @@ setup(
     version='0.1',
     install_requires=[
         "SQLAlchemy",
+        "requests",
         "BeautifulSoup4",
         "python-magic",
         "twill",
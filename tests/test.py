@@ -12,7 +12,7 @@ from polyscraper.poly import PolyScraper
 
 def dummy_get_soup(self, url):
     return BeautifulSoup(open('/tmp/dpl.html').read())
-def dummy_get_file(self, url):
+def dummy_get_file(self, url, filename=None):
     url_match = {
         'http://explore.data.gov/download/5kvc-rp2e/CSV': '/tmp/git/data.gov/Department of Commerce/Bureau of Industry and Security/Denied Persons List with Denied US Export Privileges/CSV',
         'http://explore.data.gov/download/5kvc-rp2e/RDF': '/tmp/git/data.gov/Department of Commerce/Bureau of Industry and Security/Denied Persons List with Denied US Export Privileges/RDF',
@@ -118,6 +118,6 @@ class test_data_gov_handler(unittest.TestCase):
 * State:
 * Country: ZA
 * Postal_Code: 2104
-* Effective_Date: 08/08/1997
-* Expiration_Date: 08/08/2017
+* Effective_Date: 1997-08-08
+* Expiration_Date: 2017-08-08
 * Standard_Order: Y""")
@@ -0,0 +1,78 @@
+from __future__ import print_function, unicode_literals
+import os
+import gzip
+import shutil
+import tarfile
+import zipfile
+import tempfile
+import unittest
+
+from nose.tools import eq_, raises
+
+from polyscraper import archive
+
+
+class test_archive(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.dir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_zip(self):
+        with zipfile.ZipFile(self.path('data.zip'), 'w') as z:
+            z.writestr('a.csv', b'a,b\n1,2\n')
+            z.writestr('sub/b.csv', b'c,d\n3,4\n')
+        eq_(archive.get_format(self.path('data.zip')), 'zip')
+        extracted = archive.extract(self.path('data.zip'), self.dest)
+        eq_(sorted(os.path.relpath(p, self.dest) for p in extracted),
+            ['a.csv', os.path.join('sub', 'b.csv')])
+        eq_(open(os.path.join(self.dest, 'sub', 'b.csv'), 'rb').read(),
+            b'c,d\n3,4\n')
+
+    def test_replaces_links(self):
+        # A file linked in from the blob store is replaced, not overwritten
+        os.makedirs(self.dest)
+        with open(self.path('blob'), 'wb') as f:
+            f.write(b'stored')
+        os.link(self.path('blob'), os.path.join(self.dest, 'a.csv'))
+        with zipfile.ZipFile(self.path('data.zip'), 'w') as z:
+            z.writestr('a.csv', b'a,b\n1,2\n')
+        archive.extract(self.path('data.zip'), self.dest, workers=1)
+        eq_(open(os.path.join(self.dest, 'a.csv'), 'rb').read(),
+            b'a,b\n1,2\n')
+        eq_(open(self.path('blob'), 'rb').read(), b'stored')
+        eq_(sorted(os.listdir(self.dest)), ['a.csv'])
+
+    def test_tar(self):
+        with open(self.path('a.csv'), 'wb') as f:
+            f.write(b'a,b\n1,2\n')
+        with tarfile.open(self.path('data.tar.gz'), 'w:gz') as t:
+            t.add(self.path('a.csv'), 'a.csv')
+        eq_(archive.get_format(self.path('data.tar.gz')), 'tar')
+        eq_(archive.list_members(self.path('data.tar.gz')), ['a.csv'])
+        archive.extract(self.path('data.tar.gz'), self.dest)
+        eq_(open(os.path.join(self.dest, 'a.csv'), 'rb').read(),
+            b'a,b\n1,2\n')
+
+    def test_gzip(self):
+        with gzip.open(self.path('a.csv.gz'), 'wb') as f:
+            f.write(b'a,b\n1,2\n')
+        eq_(archive.extract(self.path('a.csv.gz'), self.dest),
+            [os.path.join(self.dest, 'a.csv')])
+
+    @raises(archive.ArchiveError)
+    def test_outside_dest(self):
+        with zipfile.ZipFile(self.path('evil.zip'), 'w') as z:
+            z.writestr('../evil.csv', b'a,b\n')
+        archive.extract(self.path('evil.zip'), self.dest)
+
+    @raises(archive.ArchiveError)
+    def test_unknown(self):
+        with open(self.path('a.csv'), 'wb') as f:
+            f.write(b'a,b\n1,2\n')
+        archive.get_format(self.path('a.csv'))
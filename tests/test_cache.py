@@ -0,0 +1,103 @@
+from __future__ import print_function, unicode_literals
+import unittest
+
+from nose.tools import eq_
+from sqlalchemy import create_engine
+from sqlalchemy.orm import object_session
+from knowledge.model import init_model, metadata, DBSession, Entity
+
+from polyscraper.cache import EntityCache, PageCache
+
+
+class test_entity_cache(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        init_model(engine)
+        metadata.create_all(engine)
+        self.cache = EntityCache()
+
+    def tearDown(self):
+        DBSession.remove()
+
+    def test_added(self):
+        eq_(self.cache.get('http://a.gov/'), None)
+        entity = Entity(name='http://a.gov/')
+        DBSession.add(entity)
+        assert self.cache.get('http://a.gov/') is entity
+
+    def test_after_remove(self):
+        entity = Entity(name='http://a.gov/')
+        entity['repo'] = 'a.gov'
+        DBSession.add(entity)
+        DBSession.commit()
+        assert self.cache.get('http://a.gov/') is entity
+
+        # The next scrape gets a new session
+        DBSession.remove()
+        entity = self.cache.get('http://a.gov/')
+        assert object_session(entity) is DBSession()
+        eq_(entity['repo'], 'a.gov')
+
+
+class test_page_cache(unittest.TestCase):
+    def setUp(self):
+        # Room for three 10 byte pages, or one with a tree and a bit more
+        self.cache = PageCache(max_bytes=60)
+
+    def put(self, url, size=10):
+        return self.cache.put(url, b'x' * size, {})
+
+    def test_lru(self):
+        self.put('a')
+        self.put('b')
+        self.put('c')
+        eq_(self.cache.size, 30)
+        # Using a page makes it the most recently used
+        self.cache.get('a')
+        self.put('d', 31)
+        eq_(list(self.cache.pages), ['c', 'a', 'd'])
+        eq_(self.cache.get('b'), None)
+        eq_(self.cache.size, 51)
+
+    def test_replace(self):
+        self.put('a')
+        page = self.put('a', 20)
+        assert self.cache.get('a') is page
+        eq_(self.cache.size, 20)
+
+    def test_too_big(self):
+        # The last page is kept even if it doesn't fit on its own
+        self.put('a')
+        self.put('b', 100)
+        eq_(list(self.cache.pages), ['b'])
+        eq_(self.cache.size, 100)
+
+    def test_trees(self):
+        self.put('b')
+        page = self.put('a')
+        eq_(self.cache._cost(page), 10)
+        self.cache.add_tree(page, None, 'tree')
+        eq_(self.cache._cost(page), 10 * (1 + PageCache.TREE_OVERHEAD))
+        eq_(self.cache.size, 60)
+        # A tree we already have isn't counted twice
+        self.cache.add_tree(page, None, 'other tree')
+        eq_(page.trees, {None: 'tree'})
+        eq_(self.cache.size, 60)
+        # Another tree takes it over the limit, evicting the older page
+        self.cache.add_tree(page, 'links', 'tree')
+        eq_(list(self.cache.pages), ['a'])
+        eq_(self.cache.size, 90)
+        assert self.cache.get('a') is page
+
+    def test_tree_of_evicted_page(self):
+        page = self.put('a')
+        self.put('b', 60)
+        eq_(self.cache.get('a'), None)
+        self.cache.add_tree(page, None, 'tree')
+        eq_(self.cache.size, 60)
+
+    def test_clear(self):
+        self.put('a')
+        self.cache.clear()
+        eq_(self.cache.get('a'), None)
+        eq_(self.cache.size, 0)
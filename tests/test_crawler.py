@@ -0,0 +1,90 @@
+from __future__ import print_function, unicode_literals
+import unittest
+
+from bs4 import BeautifulSoup
+from nose.tools import eq_
+
+from polyscraper.crawler import BloomFilter, Crawler
+from polyscraper.scraper import NotHTML
+
+pages = {
+    'http://a.gov/': '<a href="/p1">1</a><a href="/d.csv">d</a>'
+                     '<a href="http://b.gov/x">x</a><a href="/p1#top">1</a>',
+    'http://a.gov/p1': '<a href="/p2">2</a><a href="/d.csv">d</a>'
+                       '<a href="/e.zip">e</a><a href="/big.iso">i</a>',
+    'http://a.gov/p2': '<a href="/deep.csv">d</a><a href="/p3">3</a>',
+    'http://a.gov/p3': '<a href="/deeper.csv">d</a>',
+}
+
+
+class DummyResponse(object):
+    def __init__(self, status_code, content=b''):
+        self.status_code = status_code
+        self.content = content
+
+
+class DummySession(object):
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def get(self, url, timeout=None):
+        self.requests.append((url, timeout))
+        return self.response
+
+
+class DummyScraper(object):
+    session = None
+
+    def get_soup(self, url, parse_only=None, html_only=False):
+        if url not in pages:
+            raise NotHTML(url)
+        return BeautifulSoup(pages[url], 'html.parser', parse_only=parse_only)
+
+    def get_session(self):
+        return self.session
+
+
+class DummyCrawler(Crawler):
+    def allowed(self, url):
+        return True
+
+
+class test_crawler(unittest.TestCase):
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000)
+        eq_(bloom.add('http://a.gov/'), True)
+        eq_(bloom.add('http://a.gov/'), False)
+        assert 'http://a.gov/' in bloom
+        assert 'http://b.gov/' not in bloom
+
+    def test_crawl(self):
+        crawler = DummyCrawler(DummyScraper(), ['csv', 'zip'], max_depth=2,
+                               delay=0)
+        eq_([link for link, tag in crawler.crawl('http://a.gov/')],
+            ['http://a.gov/d.csv', 'http://a.gov/e.zip',
+             'http://a.gov/deep.csv'])
+
+    def test_is_file(self):
+        crawler = DummyCrawler(DummyScraper(), ['csv', 'zip'])
+        assert crawler.is_file('http://a.gov/data/file.CSV')
+        assert crawler.is_file('http://a.gov/download/csv/1234')
+        assert not crawler.is_file('http://a.gov/about.html')
+
+    def test_robots(self):
+        scraper = DummyScraper()
+        scraper.session = DummySession(DummyResponse(
+            200, b'User-agent: *\nDisallow: /private/\n'))
+        crawler = Crawler(scraper, ['csv'])
+        assert crawler.allowed('http://a.gov/public/')
+        assert not crawler.allowed('http://a.gov/private/')
+        # robots.txt is only fetched once for each host
+        eq_(scraper.session.requests,
+            [('http://a.gov/robots.txt', crawler.robots_timeout)])
+
+    def test_robots_missing(self):
+        scraper = DummyScraper()
+        scraper.session = DummySession(DummyResponse(404))
+        assert Crawler(scraper, ['csv']).allowed('http://a.gov/private/')
+        scraper.session = DummySession(DummyResponse(403))
+        assert not Crawler(scraper, ['csv']).allowed('http://a.gov/')
@@ -0,0 +1,101 @@
+from __future__ import print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import date
+
+from nose.tools import eq_
+from sqlalchemy import create_engine
+from knowledge.model import init_model, metadata, DBSession, Entity
+
+from polyscraper import export, utils
+
+
+class FakeEntity(dict):
+    parent = None
+
+    @property
+    def facts(self):
+        return self
+
+
+class test_export(unittest.TestCase):
+    def setUp(self):
+        self.parent = FakeEntity(changelog=[{'git_commit': 'abc'}])
+        self.entity = FakeEntity(table_name='civx_1234',
+                                 columns=['col_0', 'col_1', 'col_2'],
+                                 column_names=['Name', '', 'Name'],
+                                 column_types=['string', 'integer', 'date'])
+        self.entity.parent = self.parent
+
+    def test_field_names(self):
+        eq_(export.field_names(self.entity),
+            ['Name', 'col_1', 'Name_col_2'])
+
+    def test_key_is_stable(self):
+        eq_(export.export_key(self.entity), export.export_key(self.entity))
+
+    def test_changelog_invalidates(self):
+        key = export.export_key(self.entity)
+        self.parent['changelog'] = self.parent['changelog'] + [
+            {'git_commit': 'def'}]
+        assert export.export_key(self.entity) != key
+
+    def test_reload_invalidates(self):
+        key = export.export_key(self.entity)
+        self.entity['loaded_digest'] = 'f00'
+        assert export.export_key(self.entity) != key
+
+
+class test_write_parquet(unittest.TestCase):
+    def setUp(self):
+        if export.pyarrow is None:
+            raise unittest.SkipTest('pyarrow is not installed')
+        engine = create_engine('sqlite://')
+        init_model(engine)
+        metadata.create_all(engine)
+        self.entity = Entity(name='http://a.gov/grants.csv')
+        self.entity['table_name'] = 'civx_grants'
+        self.entity['columns'] = ['col_0', 'col_1', 'col_2', 'col_3', 'col_4']
+        self.entity['column_names'] = ['Name', 'Amount', 'Awarded', 'Active',
+                                       'Score']
+        self.entity['column_types'] = ['text', 'integer', 'date', 'boolean',
+                                       'float']
+        DBSession.add(self.entity)
+        DBSession.flush()
+        self.table = utils.get_table_from_entity(self.entity)
+        self.table.create(bind=DBSession.connection())
+        DBSession.connection().execute(self.table.insert(), [
+            {'col_0': 'Roads', 'col_1': 1000, 'col_2': date(1997, 8, 8),
+             'col_3': True, 'col_4': 1.5},
+            {'col_0': 'Bridges', 'col_1': None, 'col_2': date(2010, 1, 2),
+             'col_3': False, 'col_4': None},
+            {'col_0': None, 'col_1': 3, 'col_2': None, 'col_3': None,
+             'col_4': 2.25}])
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metadata.remove(self.table)
+        DBSession.remove()
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        path = os.path.join(self.dir, 'exports', 'grants.parquet')
+        # Small batches, so the rows span several row groups
+        eq_(export.write_parquet(self.entity, DBSession, path, batch_size=2),
+            3)
+        table = export.pyarrow.parquet.read_table(path)
+        eq_(table.num_rows, 3)
+        eq_([(field.name, str(field.type)) for field in table.schema],
+            [('Name', 'string'), ('Amount', 'int32'),
+             ('Awarded', 'date32[day]'), ('Active', 'bool'),
+             ('Score', 'double')])
+        eq_(table.to_pydict(), {
+            'Name': ['Roads', 'Bridges', None],
+            'Amount': [1000, None, 3],
+            'Awarded': [date(1997, 8, 8), date(2010, 1, 2), None],
+            'Active': [True, False, None],
+            'Score': [1.5, None, 2.25]})
+        eq_(os.listdir(os.path.dirname(path)), ['grants.parquet'])
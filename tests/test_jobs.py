@@ -0,0 +1,84 @@
+from __future__ import print_function, unicode_literals
+import time
+import unittest
+
+from nose.tools import eq_
+
+from polyscraper.jobs import MemoryQueue, SQLiteQueue, Runner
+
+
+class QueueTests(object):
+    def test_priority(self):
+        self.queue.push('http://a.gov/1')
+        self.queue.push('http://a.gov/2', priority=5)
+        eq_(self.queue.pop(), 'http://a.gov/2')
+        eq_(self.queue.pop(), 'http://a.gov/1')
+        eq_(self.queue.pop(), None)
+
+    def test_dedup(self):
+        eq_(self.queue.push('http://a.gov/1'), True)
+        eq_(self.queue.push('http://a.gov/1'), False)
+        url = self.queue.pop()
+        # Still in flight
+        eq_(self.queue.push(url), False)
+        self.queue.done(url)
+        eq_(self.queue.push(url), True)
+
+    def test_len(self):
+        self.queue.push('http://a.gov/1')
+        self.queue.push('http://a.gov/2')
+        self.queue.pop()
+        eq_(len(self.queue), 1)
+
+
+class test_memory_queue(QueueTests, unittest.TestCase):
+    def setUp(self):
+        self.queue = MemoryQueue()
+
+
+class test_sqlite_queue(QueueTests, unittest.TestCase):
+    def setUp(self):
+        self.queue = SQLiteQueue(':memory:')
+
+
+class test_runner(unittest.TestCase):
+    def test_host_delay(self):
+        queue = MemoryQueue()
+        queue.push('http://a.gov/1', priority=2)
+        queue.push('http://a.gov/2', priority=1)
+        queue.push('http://b.gov/1')
+        runner = Runner(queue, 'sqlite://', host_delay=60)
+        eq_(runner.next_url(), 'http://a.gov/1')
+        runner.last_start['a.gov'] = time.time()
+        # a.gov was just scraped, so b.gov jumps ahead of it
+        eq_(runner.next_url(), 'http://b.gov/1')
+        eq_(runner.deferred, ['http://a.gov/2'])
+
+    def test_max_deferred(self):
+        queue = SQLiteQueue(':memory:')
+        for i in range(5):
+            queue.push('http://a.gov/%d' % i)
+        runner = Runner(queue, 'sqlite://', host_delay=60)
+        runner.max_deferred = 2
+        runner.last_start['a.gov'] = time.time()
+        eq_(runner.next_url(), None)
+        # The rest are left queued, rather than marked running
+        eq_(len(runner.deferred), 2)
+        eq_(len(queue), 3)
+
+    def test_dead_worker(self):
+        class DeadProcess(object):
+            exitcode = -9
+            def is_alive(self):
+                return False
+        queue = MemoryQueue()
+        queue.push('http://a.gov/1')
+        runner = Runner(queue, 'sqlite://', workers=1)
+        runner.spawn = lambda worker: ('replacement', None)
+        runner.processes = [(DeadProcess(), None)]
+        runner.running[0] = queue.pop()
+        runner.reap()
+        eq_(runner.running, {})
+        eq_(runner.processes, [('replacement', None)])
+        # The URL can be queued again
+        eq_(queue.push('http://a.gov/1'), True)
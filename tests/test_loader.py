@@ -0,0 +1,183 @@
+from __future__ import print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from datetime import date
+
+from nose.tools import eq_
+from sqlalchemy import (Column, Integer, MetaData, Table, UnicodeText,
+                        create_engine, select)
+from sqlalchemy.orm import sessionmaker
+
+from polyscraper import loader, utils
+
+
+def make_table(metadata, name, width=2):
+    return Table(name, metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('graveyard', UnicodeText),
+                 *[Column('col_%d' % i, UnicodeText) for i in range(width)])
+
+
+class LoaderTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.metadata = MetaData()
+        self.table = make_table(self.metadata, 'civx_test')
+        self.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.columns = ['col_0', 'col_1']
+
+    def tearDown(self):
+        self.session.close()
+
+    def rows(self, table=None, ids=False):
+        if table is None:
+            table = self.table
+        query = select([table.c.col_0, table.c.col_1, table.c.graveyard] +
+                       (ids and [table.c.id] or []))
+        return [tuple(row) for row in self.session.connection().execute(
+            query.order_by(table.c.id))]
+
+
+class test_fit_row(unittest.TestCase):
+    def test_pad(self):
+        eq_(loader.fit_row(['a'], 3), (['a', None, None], None))
+
+    def test_trim(self):
+        eq_(loader.fit_row(['a', 'b', 'c', 'd'], 2), (['a', 'b'], 'c,d'))
+
+    def test_convert(self):
+        convert = [int, None, int]
+        eq_(loader.fit_row(['1', 'b', ''], 3, convert), ([1, 'b', None], None))
+        # Values that don't convert go to the graveyard
+        eq_(loader.fit_row(['x', 'b', '2', 'y'], 3, convert),
+            ([None, 'b', 2], 'y,col_0=x'))
+
+
+class test_copy_buffer(unittest.TestCase):
+    def test_nulls(self):
+        eq_(loader.copy_buffer([[None, '', 1, 1.5, True, 'a"b,c',
+                                 date(1997, 8, 8)]]).getvalue(),
+            b'\\N,"",1,1.5,true,"a""b,c","1997-08-08"\n')
+
+    def test_unicode(self):
+        eq_(loader.copy_buffer([['caf\xe9', '\\N'], [None, None]]).getvalue(),
+            b'"caf\xc3\xa9","\\N"\n\\N,\\N\n')
+
+
+class test_bulk_load(LoaderTests):
+    def test_load(self):
+        count = loader.bulk_load(self.session, self.table, self.columns,
+                                 [[['a', 'b'], ['c']], [['d', 'e', 'f', 'g']]])
+        eq_(count, 3)
+        eq_(self.rows(), [('a', 'b', None), ('c', None, None),
+                          ('d', 'e', 'f,g')])
+
+    def test_not_committed(self):
+        loader.bulk_load(self.session, self.table, self.columns, [[['a']]])
+        self.session.rollback()
+        eq_(self.rows(), [])
+
+
+class test_sync_rows(LoaderTests):
+    def setUp(self):
+        LoaderTests.setUp(self)
+        loader.bulk_load(self.session, self.table, self.columns,
+                         [[['a', 'b'], ['c', 'd'], ['c', 'd'],
+                           ['e', 'f', 'g']]])
+        self.before = self.rows(ids=True)
+
+    def sync(self, rows):
+        return loader.sync_rows(self.session, self.table, self.columns, rows,
+                                transaction_size=2)
+
+    def test_unchanged(self):
+        eq_(self.sync([['a', 'b'], ['c', 'd'], ['c', 'd'], ['e', 'f', 'g']]),
+            (0, 0))
+        eq_(self.rows(ids=True), self.before)
+
+    def test_appended(self):
+        eq_(self.sync([['a', 'b'], ['c', 'd'], ['c', 'd'], ['e', 'f', 'g'],
+                       ['h', 'i']]), (1, 0))
+        eq_(self.rows(ids=True)[:4], self.before)
+        eq_(self.rows()[4], ('h', 'i', None))
+
+    def test_changed(self):
+        # One copy of a duplicate row goes, a row changes, and the row in
+        # the graveyard loses its extra value
+        eq_(self.sync([['a', 'b'], ['c', 'x'], ['c', 'd'], ['e', 'f']]),
+            (2, 2))
+        eq_(sorted(self.rows()), [('a', 'b', None), ('c', 'd', None),
+                                  ('c', 'x', None), ('e', 'f', None)])
+        # The unchanged rows were left alone
+        after = self.rows(ids=True)
+        eq_(after[0], self.before[0])
+        assert after[1] in self.before[1:3]
+
+
+class test_is_appended(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'data.csv')
+        self.write(b'a,b\n1,2\n')
+        self.size = os.path.getsize(self.filename)
+        self.digest = utils.file_digest(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+
+    def test_unchanged(self):
+        assert utils.is_appended(self.filename, self.size, self.digest)
+
+    def test_appended(self):
+        self.write(b'a,b\n1,2\n3,4\n')
+        assert utils.is_appended(self.filename, self.size, self.digest)
+
+    def test_changed(self):
+        self.write(b'a,b\n1,3\n3,4\n')
+        assert not utils.is_appended(self.filename, self.size, self.digest)
+
+    def test_truncated(self):
+        self.write(b'a,b\n')
+        assert not utils.is_appended(self.filename, self.size, self.digest)
+
+
+class test_copy_table(LoaderTests):
+    def test_copy(self):
+        loader.bulk_load(self.session, self.table, self.columns,
+                         [[['a', 'b'], ['c', 'd', 'e']]])
+        copy = make_table(self.metadata, 'civx_copy')
+        copy.create(bind=self.session.connection())
+        eq_(loader.copy_table(self.session, self.table, copy), 2)
+        eq_(self.rows(copy), self.rows())
+
+        # Changing the copy leaves the original alone
+        loader.sync_rows(self.session, copy, self.columns, [['a', 'b']])
+        eq_(self.rows(copy), [('a', 'b', None)])
+        eq_(self.rows(), [('a', 'b', None), ('c', 'd', 'e')])
+
+
+class test_column_stats(unittest.TestCase):
+    def test_summary(self):
+        stats = loader.ColumnStats(3, max_distinct=3,
+                                   types=['integer', 'text', 'date'])
+        for row in [[1, 'a', None], [2, 'b', None], [3, 'c', None],
+                    [4, '', None]]:
+            stats.add(row)
+        eq_(stats.summary(), {'rows': 4, 'nulls': [0, 1, 4],
+                              'distinct': [3, None, 0]})
+        # Text columns don't hold on to their values
+        eq_(stats.values[1], None)
+
+    def test_merge(self):
+        stats = loader.merge_stats([
+            {'rows': 2, 'nulls': [0, 1], 'distinct': [2, None]},
+            {'rows': 3, 'nulls': [1, 0], 'distinct': [3, None]}])
+        eq_(stats, {'rows': 5, 'nulls': [1, 1], 'distinct': [3, None]})
@@ -0,0 +1,131 @@
+from __future__ import print_function, unicode_literals
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from nose.tools import eq_
+from sqlalchemy import create_engine
+from knowledge.model import init_model, metadata, DBSession, Entity
+
+from polyscraper import local
+from polyscraper.poly import PolyScraper
+
+
+class test_local(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name, data):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def test_iter_files(self):
+        os.makedirs(self.path('a/b'))
+        self.write('a/1.csv', b'1')
+        self.write('a/b/2.csv', b'22')
+        eq_(sorted((os.path.relpath(path, self.dir), stat.st_size)
+                   for path, stat in local.iter_files(self.path('a'))),
+            [('a/1.csv', 1), ('a/b/2.csv', 2)])
+        eq_([path for path, stat in local.iter_files(self.path('a/1.csv'))],
+            [self.path('a/1.csv')])
+
+    def test_link_or_copy(self):
+        self.write('blob', b'stored')
+        eq_(local.link_or_copy(self.path('blob'), self.path('a.csv')), 'link')
+        eq_(os.stat(self.path('a.csv')).st_ino,
+            os.stat(self.path('blob')).st_ino)
+
+    def test_clone_or_copy(self):
+        self.write('source.csv', b'original')
+        assert local.clone_or_copy(self.path('source.csv'),
+                                   self.path('a.csv')) in ('reflink', 'copy')
+        with open(self.path('a.csv'), 'wb') as f:
+            f.write(b'clobbered')
+        eq_(self.read('source.csv'), b'original')
+
+    def test_replacing(self):
+        self.write('blob', b'stored')
+        os.link(self.path('blob'), self.path('a.csv'))
+        with local.replacing(self.path('a.csv')) as out:
+            out.write(b'new')
+        eq_(self.read('a.csv'), b'new')
+        eq_(self.read('blob'), b'stored')
+        eq_(sorted(os.listdir(self.dir)), ['a.csv', 'blob'])
+
+    def test_replacing_fails(self):
+        self.write('a.csv', b'old')
+        try:
+            with local.replacing(self.path('a.csv')) as out:
+                out.write(b'half')
+                raise IOError('Disk full')
+        except IOError:
+            pass
+        eq_(self.read('a.csv'), b'old')
+        eq_(os.listdir(self.dir), ['a.csv'])
+
+
+class test_ingest_local(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        init_model(engine)
+        metadata.create_all(engine)
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        os.makedirs(self.src)
+        self.write('data.csv', b'a,b\n1,x\n2,y\n')
+        with zipfile.ZipFile(os.path.join(self.src, 'data.zip'), 'w') as z:
+            z.writestr('data.csv', b'clobbered')
+        self.scraper = PolyScraper()
+        self.scraper.config.update({
+            'git_dir': os.path.join(self.dir, 'git'),
+            'ingest_processes': 1,
+        })
+        self.scraper.init_git_repo('localhost')
+        self.entity = Entity(name='file://' + self.src)
+        DBSession.add(self.entity)
+
+    def tearDown(self):
+        DBSession.remove()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        with open(os.path.join(self.src, name), 'wb') as f:
+            f.write(data)
+
+    def ingest(self):
+        return self.scraper.ingest_local(self.src, self.entity, 'localhost')
+
+    def test_ingest(self):
+        eq_(self.ingest(), 2)
+        entity = Entity.by_name(os.path.join(self.src, 'data.csv'))
+        eq_(entity['size'], 12)
+        assert 'table_name' in entity.facts
+        # Extracting the zip over the repo's copy left the original alone
+        with open(os.path.join(self.src, 'data.csv'), 'rb') as f:
+            eq_(f.read(), b'a,b\n1,x\n2,y\n')
+
+    def test_skip_unchanged(self):
+        eq_(self.ingest(), 2)
+        eq_(self.ingest(), 0)
+        self.write('data.csv', b'a,b\n1,x\n2,y\n3,z\n')
+        eq_(self.ingest(), 1)
+
+    def test_changelog(self):
+        url = 'file://' + self.src
+        self.scraper.consume(url)
+        self.scraper.consume(url)
+        DBSession.remove()
+        changelog = Entity.by_name(url)['changelog']
+        eq_([change['num_downloads'] for change in changelog], [2, 0])
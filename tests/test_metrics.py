@@ -0,0 +1,60 @@
+from __future__ import print_function, unicode_literals
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from nose.tools import eq_
+
+from polyscraper.metrics import Metrics, PrometheusFile, StatsD
+
+
+class test_metrics(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        with self.metrics.timer('fetch'):
+            pass
+        with self.metrics.timer('fetch'):
+            pass
+        self.metrics.count('fetch', bytes=100)
+        self.metrics.count('load', rows=10)
+
+    def test_summary(self):
+        summary = self.metrics.summary()
+        eq_(summary['fetch']['calls'], 2)
+        eq_(summary['fetch']['bytes'], 100)
+        eq_(summary['load']['rows'], 10)
+        eq_(summary['load']['seconds'], 0)
+
+    def test_reset(self):
+        self.metrics.reset()
+        eq_(self.metrics.summary(), {})
+
+    def test_prometheus(self):
+        dirname = tempfile.mkdtemp()
+        try:
+            path = os.path.join(dirname, 'polyscraper.prom')
+            sink = PrometheusFile(path)
+            sink.emit(self.metrics.summary())
+            sink.emit(self.metrics.summary())
+            with open(path) as prom:
+                lines = prom.read().splitlines()
+            assert 'polyscraper_scrapes_total 2' in lines
+            assert 'polyscraper_stage_bytes_total{stage="fetch"} 200.0' in lines
+            assert 'polyscraper_stage_rows_total{stage="load"} 20.0' in lines
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            sink = StatsD('127.0.0.1:%d' % server.getsockname()[1])
+            sink.emit(self.metrics.summary())
+            lines = server.recv(2048).decode('ascii').splitlines()
+            assert 'polyscraper.fetch.bytes:100|c' in lines
+            assert 'polyscraper.load.rows:10|c' in lines
+        finally:
+            server.close()
@@ -0,0 +1,79 @@
+from __future__ import print_function, unicode_literals
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import eq_
+
+from polyscraper import reader
+
+
+class test_reader(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        filename = os.path.join(self.dir, 'data.csv')
+        with open(filename, 'wb') as csv_file:
+            csv_file.write(data)
+        return filename
+
+    def test_sniff_delimiter(self):
+        filename = self.write(b'a;b;c\n1;"x;y";3\n4;5;6\n')
+        dialect, encoding = reader.sniff(filename)
+        eq_(dialect.delimiter, ';')
+        eq_(encoding, 'utf-8')
+
+    def test_rows(self):
+        filename = self.write(b'a;b;c\n1;"x;y";3\n4;5;6\n')
+        dialect, encoding = reader.sniff(filename)
+        eq_(list(reader.iter_rows(filename, dialect, encoding)),
+            [['a', 'b', 'c'], ['1', 'x;y', '3'], ['4', '5', '6']])
+
+    def test_utf8_bom(self):
+        filename = self.write(b'\xef\xbb\xbfa,b\n\xc3\xa9,2\n')
+        dialect, encoding = reader.sniff(filename)
+        eq_(list(reader.iter_rows(filename, dialect, encoding)),
+            [['a', 'b'], ['\xe9', '2']])
+
+    def test_latin1(self):
+        filename = self.write(b'a,b\n\xe9,2\n')
+        dialect, encoding = reader.sniff(filename)
+        eq_(encoding, 'windows-1252')
+        eq_(list(reader.iter_rows(filename, dialect, encoding))[1],
+            ['\xe9', '2'])
+
+    def test_batches(self):
+        eq_(list(reader.iter_batches(range(5), 2)), [(0, 1), (2, 3), (4,)])
+
+    def test_infer_types(self):
+        rows = [['1', '1.5', '2010-01-02', 'yes', '007', 'x', ''],
+                ['-20', '3', '1/2/2010', 'No', '010', 'x' * 300, ''],
+                ['', '', '', '', '', '', '']]
+        eq_(reader.infer_types(rows, 7),
+            ['integer', 'float', 'date', 'boolean', 'string', 'text', 'text'])
+
+    def test_widen_types(self):
+        eq_(reader.infer_types([['1'], ['99999999999']], 1), ['bigint'])
+        eq_(reader.infer_types([['1'], ['n/a']], 1), ['string'])
+        eq_(reader.infer_types([['t'], ['1']], 1), ['string'])
+
+    def test_split_ranges(self):
+        data = b'a,b\n' + b''.join(b'%d,"x\ny ""%d"""\n' % (i, i)
+                                   for i in range(100))
+        filename = self.write(data)
+        dialect, encoding = csv.excel, 'utf-8'
+        ranges = reader.split_ranges(filename, dialect, 7)
+        assert len(ranges) > 1
+        eq_(ranges[0][0], 4)
+        eq_(ranges[-1][1], len(data))
+        rows = []
+        for start, end in ranges:
+            rows.extend(reader.iter_rows(filename, dialect, encoding,
+                                         start, end))
+        eq_(rows, [[str(i), 'x\ny "%d"' % i] for i in range(100)])
@@ -0,0 +1,55 @@
+from __future__ import print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import eq_
+
+from polyscraper.repo import GitRepo
+
+
+class test_repo(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.repo = GitRepo(os.path.join(self.dir, 'data.gov'))
+        self.repo.init()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        filename = os.path.join(self.repo.path, name)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(data)
+        self.repo.add(filename)
+        return filename
+
+    def test_empty_commit(self):
+        eq_(self.repo.commit('Nothing'), None)
+        eq_(self.repo.head(), None)
+
+    def test_commit(self):
+        self.write('Agency/data.csv', b'a,b\n1,2\n')
+        self.write('other.csv', b'c,d\n')
+        commit = self.repo.commit('Scraped')
+        eq_(commit, self.repo.head())
+        eq_(self.repo.git('show', commit + ':Agency/data.csv'), b'a,b\n1,2')
+        eq_(self.repo.git('status', '--porcelain'), None)
+
+    def test_history(self):
+        first = self.write('data.zip', b'zip')
+        self.repo.commit('First')
+        os.unlink(first)
+        self.repo.add(first)
+        self.write('data.csv', b'a,b\n')
+        second = self.repo.commit('Second')
+        eq_(self.repo.git('rev-parse', second + '^'),
+            self.repo.git('rev-list', '--max-parents=0', 'HEAD'))
+        eq_(self.repo.git('ls-tree', '--name-only', second), b'data.csv')
+
+    def test_outside_repo(self):
+        self.repo.add(os.path.join(self.dir, 'elsewhere.csv'))
+        eq_(self.repo.pending, set())
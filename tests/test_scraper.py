@@ -0,0 +1,169 @@
+from __future__ import print_function, unicode_literals
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+from nose.tools import eq_, raises
+
+from polyscraper.cache import PageCache
+from polyscraper.scraper import NotHTML, Scraper
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.data with server.etag, honouring Range, If-Range and
+    If-None-Match
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.status:
+            self.send_response(server.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        if (self.headers.get('Range') and
+            self.headers.get('If-Range') == server.etag):
+            start = int(self.headers['Range'][6:].split('-')[0])
+        self.send_response(start and 206 or 200)
+        self.send_header('ETag', server.etag)
+        if server.content_type:
+            self.send_header('Content-Type', server.content_type)
+        self.send_header('Content-Length', str(len(server.data) - start))
+        self.end_headers()
+        self.wfile.write(server.data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DummyScraper(Scraper):
+    log = logging.getLogger('PolyScraper')
+    config = {'download_retries': 2}
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FileHandler)
+        self.server.data = b'0123456789'
+        self.server.etag = '"v1"'
+        self.server.content_type = None
+        self.server.status = None
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/data.csv' % self.server.server_port
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'data.csv')
+        self.scraper = DummyScraper()
+        self.scraper.get_session().trust_env = False
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+
+class test_fetch_file(ServerTests):
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def test_resume(self):
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(b'01234')
+        self.scraper.fetch_file(self.url, self.filename, {'etag': '"v1"'})
+        eq_(self.read(), b'0123456789')
+        eq_(self.server.requests[0]['range'], 'bytes=5-')
+        eq_(self.server.requests[0]['if-range'], '"v1"')
+
+    def test_resume_changed(self):
+        # The partial file came from an older version of the file
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(b'abcde')
+        self.server.etag = '"v2"'
+        filename, validators = self.scraper.fetch_file(
+            self.url, self.filename, {'etag': '"v1"'})
+        eq_(self.read(), b'0123456789')
+        eq_(validators['etag'], '"v2"')
+
+    def test_resume_without_validators(self):
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(b'abcde')
+        self.scraper.fetch_file(self.url, self.filename)
+        eq_(self.read(), b'0123456789')
+        assert 'range' not in self.server.requests[0]
+
+    @raises(requests.HTTPError)
+    def test_client_errors_are_not_retried(self):
+        self.server.status = 404
+        try:
+            self.scraper.fetch_file(self.url, self.filename)
+        finally:
+            eq_(len(self.server.requests), 1)
+
+    def test_local_file_replaces_links(self):
+        source = os.path.join(self.dir, 'source.csv')
+        blob = os.path.join(self.dir, 'blob')
+        with open(source, 'wb') as f:
+            f.write(b'new')
+        with open(blob, 'wb') as f:
+            f.write(b'stored')
+        os.link(blob, self.filename)
+        self.scraper.fetch_file(source, self.filename)
+        eq_(self.read(), b'new')
+        eq_(open(blob, 'rb').read(), b'stored')
+
+
+class test_get_page(ServerTests):
+    def setUp(self):
+        ServerTests.setUp(self)
+        self.scraper.page_cache = PageCache()
+        self.server.data = b'<a href="/data.csv">data</a>'
+
+    def test_html(self):
+        self.server.content_type = 'text/html; charset=utf-8'
+        page = self.scraper.get_page(self.url, html_only=True)
+        eq_(page.body, self.server.data)
+
+    @raises(NotHTML)
+    def test_not_html(self):
+        self.server.content_type = 'text/csv'
+        try:
+            self.scraper.get_page(self.url, html_only=True)
+        finally:
+            eq_(self.scraper.page_cache.get(self.url), None)
+
+    def test_revalidate(self):
+        self.scraper.config = dict(self.scraper.config, page_max_age=0)
+        page = self.scraper.get_page(self.url)
+        page.checked = 0
+        # Our copy is still current
+        assert self.scraper.get_page(self.url) is page
+        eq_(self.server.requests[-1]['if-none-match'], '"v1"')
+        assert page.checked > 0
+        # The page changed
+        self.server.etag = '"v2"'
+        self.server.data = b'<a href="/other.csv">other</a>'
+        changed = self.scraper.get_page(self.url)
+        eq_(changed.body, self.server.data)
+        eq_(changed.validators['etag'], '"v2"')
+        assert self.scraper.page_cache.get(self.url) is changed
+
+    def test_fresh(self):
+        page = self.scraper.get_page(self.url)
+        assert self.scraper.get_page(self.url) is page
+        eq_(len(self.server.requests), 1)
@@ -0,0 +1,81 @@
+from __future__ import print_function, unicode_literals
+import unittest
+
+from nose.tools import eq_
+from sqlalchemy import (Column, Integer, MetaData, Table, UnicodeText,
+                        create_engine, select)
+from sqlalchemy.orm import sessionmaker
+from knowledge.model import init_model, metadata, DBSession, Entity
+
+from polyscraper import loader
+from polyscraper.session import UnitOfWork
+
+
+class test_savepoint(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.table = Table('civx_test', MetaData(),
+                           Column('id', Integer, primary_key=True),
+                           Column('col_0', UnicodeText),
+                           Column('graveyard', UnicodeText))
+        self.table.create(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.uow = UnitOfWork(self.session, {})
+
+    def tearDown(self):
+        self.session.close()
+
+    def load(self, values, fail=False):
+        with self.uow.savepoint('file'):
+            loader.bulk_load(self.session, self.table, ['col_0'],
+                             [[[value] for value in values]])
+            if fail:
+                raise ValueError('Bad file')
+
+    def values(self):
+        return [row[0] for row in self.session.connection().execute(
+            select([self.table.c.col_0]).order_by(self.table.c.id))]
+
+    def test_failing_file_only_rolls_back_itself(self):
+        self.load(['a', 'b'])
+        self.load(['c', 'd'], fail=True)
+        self.load(['e'])
+        self.session.commit()
+        eq_(self.values(), ['a', 'b', 'e'])
+
+    def test_failing_sync_rolls_back(self):
+        self.load(['a', 'b'])
+        with self.uow.savepoint('file'):
+            loader.sync_rows(self.session, self.table, ['col_0'],
+                             [['b'], ['c']])
+            raise ValueError('Bad file')
+        self.session.commit()
+        eq_(self.values(), ['a', 'b'])
+
+
+class test_savepoint_entities(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        init_model(engine)
+        metadata.create_all(engine)
+        self.uow = UnitOfWork(DBSession, {})
+
+    def tearDown(self):
+        DBSession.remove()
+
+    def test_failing_file_only_rolls_back_itself(self):
+        parent = Entity(name='http://a.gov/')
+        DBSession.add(parent)
+        for name, fail in (('1.csv', False), ('2.csv', True),
+                           ('3.csv', False)):
+            with self.uow.savepoint(name):
+                entity = Entity(name=name)
+                entity['filename'] = name
+                entity.parent = parent
+                DBSession.add(entity)
+                DBSession.flush()
+                if fail:
+                    raise ValueError('Bad file')
+        DBSession.commit()
+        eq_(sorted(parent.children.keys()), ['1.csv', '3.csv'])
+        eq_(Entity.by_name('2.csv'), None)
@@ -0,0 +1,66 @@
+from __future__ import print_function, unicode_literals
+import json
+import unittest
+
+from datetime import date
+
+from nose.tools import eq_
+from sqlalchemy import create_engine
+from knowledge.model import init_model, metadata, DBSession, Entity
+
+from polyscraper import utils
+
+
+class test_dynamic_model(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        init_model(engine)
+        metadata.create_all(engine)
+        self.entity = Entity(name='http://a.gov/releases.csv')
+        self.entity['table_name'] = 'civx_releases'
+        self.entity['columns'] = ['col_0', 'col_1']
+        self.entity['column_names'] = ['Title', 'Released']
+        self.entity['column_types'] = ['text', 'date']
+        DBSession.add(self.entity)
+        DBSession.flush()
+        self.table, self.model = utils.get_mapped_table_model_from_entity(
+                self.entity)
+        self.table.create(bind=DBSession.connection())
+        # Inserted out of order, to check rows come back in id order
+        DBSession.connection().execute(self.table.insert(), [
+            {'id': 3, 'col_0': 'Third', 'col_1': None},
+            {'id': 1, 'col_0': 'First', 'col_1': date(1997, 8, 8)},
+            {'id': 2, 'col_0': 'Second', 'col_1': date(2010, 1, 2)}])
+
+    def tearDown(self):
+        utils.dispose_model(self.table, self.model)
+        utils._models.pop('civx_releases', None)
+        DBSession.remove()
+
+    def test_page(self):
+        eq_([tuple(row) for row in self.model.page()],
+            [('First', date(1997, 8, 8)), ('Second', date(2010, 1, 2)),
+             ('Third', None)])
+        eq_([tuple(row) for row in self.model.page(offset=1, limit=1)],
+            [('Second', date(2010, 1, 2))])
+
+    def test_render(self):
+        eq_(self.model.render(self.model.page(limit=2)),
+            'http://a.gov/releases.csv\n * Title: First\n'
+            ' * Released: 1997-08-08\n'
+            'http://a.gov/releases.csv\n * Title: Second\n'
+            ' * Released: 2010-01-02')
+        eq_(repr(DBSession.query(self.model).get(3)),
+            'http://a.gov/releases.csv\n * Title: Third\n * Released: None')
+
+    def test_to_json(self):
+        eq_(json.loads(self.model.to_json(self.model.page())),
+            {'columns': ['Title', 'Released'],
+             'rows': [['First', '1997-08-08'], ['Second', '2010-01-02'],
+                      ['Third', None]]})
+
+    def test_columns_from_facts(self):
+        # A model that wasn't described finds its entity by its table name
+        self.model.__civx_columns__ = None
+        eq_(self.model.columns(),
+            [('col_0', 'Title'), ('col_1', 'Released')])